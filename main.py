@@ -5,23 +5,63 @@
 """
 
 import logging
+import logging.handlers
 import sqlite3
 import random
 import asyncio
 import datetime
 import yaml
 import os
+import time
+import gzip
+import shutil
+import threading
+import sys
+import signal
+import argparse
+import csv
+import hashlib
+import hmac
+import secrets
+import json
+import statistics
+import tempfile
+import tracemalloc
+import queue
+import atexit
+import functools
+import contextvars
+import math
+import bisect
+from array import array
+from collections import OrderedDict
 from typing import Dict, List, Tuple, Optional
 from enum import Enum
+import dataclasses
 from dataclasses import dataclass
 from contextlib import contextmanager
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+try:
+    import numpy as np
+except ImportError:  # нужен только для симулятора экономики
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # нужен только для экспорта в parquet
+    pa = pq = None
+
+from telegram import Update, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
+    CallbackContext,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
@@ -38,6 +78,8 @@ DEFAULT_CONFIG = {
         "quiz_interval": 300,  # 5 минут
         "salary_interval": 3600,  # 1 час
         "decay_interval": 1800,  # 30 минут
+        "events_interval": 2400,  # 40 минут
+        "server_interval": 900,  # 15 минут
         "start_balance": 1000,
         "quiz_reward": 50,
         "work_reward": 200,
@@ -55,23 +97,268 @@ DEFAULT_CONFIG = {
         "car": 5000,
         "house": 20000,
         "business": 10000
+    },
+    "scheduler": {
+        "poll_interval": 5,  # как часто проверять наступившие задачи
+        "catchup_batch": 50,  # сколько задач забирать из расписания за один запрос
+        "poll_batches": 4,  # не больше стольких запросов за проверку, остальное - в следующую
+        "poll_budget": 0.5  # секунд на одну проверку, пока есть наступившие задачи
+    },
+    "lifecycle": {
+        "idle_days": 7,  # через сколько дней тишины чат засыпает
+        "sweep_interval": 600  # как часто проверять неактивные чаты
+    },
+    "quizzes": {
+        "timeout": 240,  # сколько секунд викторина принимает ответы
+        "keep_days": 7,  # сколько хранить завершенные викторины
+        "sweep_interval": 600,
+        "sweep_batch": 500  # строк за один запрос очистки
+    },
+    "ledger": {
+        "flush_interval": 5,  # как часто записывать накопленные проводки
+        "flush_size": 500,  # записать раньше, если накопилось столько проводок
+        "snapshot_interval": 300  # как часто переносить проводки в балансы
+    },
+    "render_cache": {
+        "max_size": 10000  # сколько сообщений помнить
+    },
+    "recorder": {
+        "enabled": False,  # записывать входящие апдейты для воспроизведения
+        "path": "updates.jsonl.gz",
+        "salt": ""  # соль для обезличивания id, создается при первом запуске
+    },
+    "stats": {
+        "recompute_interval": 3600  # полный пересчет статистики чатов
+    },
+    "export": {
+        "chunk_size": 5000,  # строк за одно чтение
+        "pause": 0.01  # пауза между чтениями, чтобы не мешать боту
+    },
+    "profiler": {
+        "dir": "profiles",
+        "default_seconds": 30,
+        "interval": 0.01  # период выборки стека, 100 раз в секунду
+    },
+    "activity": {
+        "flush_interval": 60  # как часто записывать активность игроков
+    },
+    "sender": {
+        "concurrency": 20  # одновременных запросов при массовой отправке
+    },
+    "digest": {
+        "window": 300,  # несрочные уведомления копятся до 5 минут, 0 - отправлять сразу
+        "flush_interval": 15
+    },
+    "admin": {
+        "user_ids": []  # кому доступны служебные команды
+    },
+    "backup": {
+        "interval": 86400,  # раз в сутки, 0 - только по команде
+        "dir": "backups",
+        "pages_per_step": 64,  # страниц за один шаг копирования
+        "step_pause": 0.05,  # пауза между шагами, чтобы не мешать записи
+        "compress": True,
+        "keep": 7  # сколько последних копий хранить
+    },
+    "maintenance": {
+        "interval": 60,  # как часто выполнять шаг обслуживания БД
+        "budget": 0.2,  # секунд на один шаг
+        "vacuum_pages": 64,  # страниц за один вызов incremental_vacuum
+        "optimize_interval": 3600,
+        "integrity_interval": 86400
+    },
+    "logging": {
+        "level": "INFO",
+        "json": True,  # файл лога - JSON по записи на строку
+        "max_bytes": 10 * 1024 * 1024,  # ротация по размеру
+        "backup_count": 5,
+        "error_burst": 5,  # одинаковых ошибок с одного места за окно
+        "error_window": 60
     }
 }
 
+
+def merge_config(defaults: dict, loaded: dict) -> dict:
+    """Дополнить загруженный конфиг отсутствующими ключами по умолчанию"""
+    merged = dict(defaults)
+    for key, value in (loaded or {}).items():
+        if isinstance(value, dict) and isinstance(defaults.get(key), dict):
+            merged[key] = merge_config(defaults[key], value)
+        else:
+            merged[key] = value
+    return merged
+
 # ==================== ЛОГИРОВАНИЕ ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FIELDS = ("chat_id", "user_id", "handler", "suppressed")
+
+# Поля текущего апдейта или задачи, которые попадают во все записи лога
+log_context = contextvars.ContextVar("log_context", default={})
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи поля из log_context (в потоке, который пишет в лог)"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_context.get().items():
+            setattr(record, key, value)
+        return True
+
+
+class RepeatFilter(logging.Filter):
+    """Не больше burst предупреждений и ошибок с одного места за window секунд"""
+    
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._seen = {}  # (файл, строка) -> [начало окна, пропущено, подавлено]
+        self._lock = threading.Lock()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+            
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            state = self._seen.get(key)
+            if state is None or now - state[0] >= self.window:
+                # Новое окно: сообщаем, сколько записей подавили в предыдущем
+                if state and state[2]:
+                    record.suppressed = state[2]
+                self._seen[key] = [now, 1, 0]
+                return True
+            if state[1] < self.burst:
+                state[1] += 1
+                return True
+            state[2] += 1
+            return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def log_context_for(callback):
+    """Обертка обработчика или задачи: chat_id, user_id и имя попадают в ее записи лога"""
+    @functools.wraps(callback)
+    async def wrapper(*args):
+        fields = {"handler": callback.__name__}
+        if args and isinstance(args[0], Update):
+            if args[0].effective_chat:
+                fields["chat_id"] = args[0].effective_chat.id
+            if args[0].effective_user:
+                fields["user_id"] = args[0].effective_user.id
+        token = log_context.set(fields)
+        try:
+            return await callback(*args)
+        finally:
+            log_context.reset(token)
+    return wrapper
+
+
+_log_listener = None
+
+
+def setup_logging(settings: dict):
+    """Лог через очередь: запись на диск и в консоль идет в фоновом потоке"""
+    global _log_listener
+    stop_logging()
+    
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=settings["max_bytes"],
+        backupCount=settings["backup_count"],
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter() if settings["json"] else logging.Formatter(LOG_FORMAT))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RepeatFilter(settings["error_burst"], settings["error_window"]))
+    queue_handler.addFilter(ContextFilter())
+    
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(settings["level"])
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    _log_listener.start()
+
+
+def stop_logging():
+    """Дописать очередь лога и остановить фоновый поток"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+setup_logging(DEFAULT_CONFIG["logging"])
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
+# ==================== ЧАСЫ ====================
+class Clock:
+    """Источник времени для игры: реальные часы"""
+    
+    def time(self) -> float:
+        return time.time()
+    
+    def timestamp(self) -> str:
+        """Текущее время в формате CURRENT_TIMESTAMP (UTC)"""
+        moment = datetime.datetime.fromtimestamp(self.time(), datetime.timezone.utc)
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class VirtualClock(Clock):
+    """Виртуальные часы: время идет только при явном сдвиге"""
+    
+    def __init__(self, start: Optional[float] = None):
+        self.now = time.time() if start is None else start
+    
+    def time(self) -> float:
+        return self.now
+    
+    def set(self, moment: float):
+        self.now = moment
+    
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+clock = Clock()
+
+
+def use_clock(new_clock: Clock):
+    """Подменить часы игры (для воспроизведения и нагрузочных прогонов)"""
+    global clock
+    clock = new_clock
+
 # ==================== БАЗА ДАННЫХ ====================
 class Database:
     _instance = None
+    db_file = DB_FILE
     
     def __new__(cls):
         if cls._instance is None:
@@ -81,9 +368,16 @@ class Database:
     
     def init_db(self):
         """Инициализация базы данных"""
-        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        # Время в запросах берется из часов игры, а не из CURRENT_TIMESTAMP
+        self.conn.create_function("clock_now", 0, lambda: clock.timestamp())
         self.cursor = self.conn.cursor()
+        self._record_cursors = {}  # тип записи -> курсор со своей row_factory
+        
+        # Новые БД освобождают место постранично; существующим нужен разовый VACUUM
+        self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.cursor.execute("PRAGMA journal_mode = WAL")
         
         # Основные таблицы
         self.cursor.executescript('''
@@ -158,6 +452,40 @@ class Database:
                 active BOOLEAN DEFAULT 1,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+            
+            CREATE INDEX IF NOT EXISTS idx_quizzes_chat ON quizzes (chat_id, active);
+            CREATE INDEX IF NOT EXISTS idx_quizzes_active ON quizzes (active, created_at);
+            
+            CREATE TABLE IF NOT EXISTS chat_schedule (
+                chat_id INTEGER,
+                tick TEXT,
+                next_due REAL,
+                PRIMARY KEY (chat_id, tick)
+            );
+            
+            CREATE INDEX IF NOT EXISTS idx_chat_schedule_due ON chat_schedule (next_due);
+            
+            CREATE TABLE IF NOT EXISTS balance_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                amount INTEGER,
+                reason TEXT,
+                chat_id INTEGER,
+                created_at REAL
+            );
+            
+            CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, id);
+            
+            CREATE TABLE IF NOT EXISTS ledger_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                last_activity REAL,
+                hibernated BOOLEAN DEFAULT 0
+            );
         ''')
         self.conn.commit()
         logger.info("База данных инициализирована")
@@ -173,6 +501,28 @@ class Database:
             self.conn.rollback()
             raise
     
+    def execute_many(self, query: str, seq_of_params):
+        """Выполнить SQL-запрос для набора параметров одной транзакцией"""
+        try:
+            self.cursor.executemany(query, seq_of_params)
+            self.conn.commit()
+            return self.cursor
+        except Exception as e:
+            logger.error(f"Ошибка БД: {e}")
+            self.conn.rollback()
+            raise
+    
+    @contextmanager
+    def transaction(self):
+        """Выполнить несколько запросов одной транзакцией"""
+        try:
+            yield self.cursor
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка БД: {e}")
+            self.conn.rollback()
+            raise
+    
     def fetch_one(self, query: str, params: tuple = ()):
         """Получить одну запись"""
         self.cursor.execute(query, params)
@@ -182,6 +532,156 @@ class Database:
         """Получить все записи"""
         self.cursor.execute(query, params)
         return self.cursor.fetchall()
+    
+    def fetch_record(self, record_type, user_id: int):
+        """Получить строку игрока как запись record_type (только ее столбцы)"""
+        cursor = self._record_cursors.get(record_type)
+        if cursor is None:
+            cursor = self._record_cursors[record_type] = self.conn.cursor()
+            cursor.row_factory = record_type.from_row
+        return cursor.execute(record_type.SELECT, (user_id,)).fetchone()
+
+# ==================== ЗАПИСИ ====================
+def record_type(table: str):
+    """Запись строки таблицы: выбираются только поля записи, без промежуточного dict"""
+    def decorate(cls):
+        names = [field.name for field in dataclasses.fields(cls)]
+        cls.SELECT = f"SELECT {', '.join(names)} FROM {table} WHERE user_id = ?"
+        cls.from_row = staticmethod(lambda cursor, row: cls(*row))
+        return cls
+    return decorate
+
+
+@record_type("users")
+@dataclass(slots=True)
+class User:
+    user_id: int
+    username: Optional[str]
+    balance: int
+    health: int
+    energy: int
+    happiness: int
+
+
+@record_type("user_properties")
+@dataclass(slots=True)
+class Properties:
+    user_id: int
+    has_girlfriend: int
+    girlfriend_happiness: int
+    has_pet: int
+    pet_hunger: int
+    has_car: int
+    car_condition: int
+    has_house: int
+    house_comfort: int
+    has_business: int
+    business_level: int
+
+
+@record_type("servers")
+@dataclass(slots=True)
+class Server:
+    user_id: int
+    level: int
+    income: int
+
+
+@record_type("jobs")
+@dataclass(slots=True)
+class Job:
+    user_id: int
+    job_type: str
+    salary: int
+    stress_level: int
+
+# ==================== ЖУРНАЛ БАЛАНСОВ ====================
+class BalanceLedger:
+    """Журнал движения денег: проводки только добавляются, балансы обновляются снимками"""
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.init_ledger()
+        return cls._instance
+    
+    def init_ledger(self):
+        self.db = Database()
+        self.flush_size = 500
+        self._pending = []  # проводки, еще не записанные в БД
+        self._pending_sums = {}  # user_id -> сумма незаписанных проводок
+        # users.balance уже включает все проводки с id не больше snapshot_id
+        row = self.db.fetch_one("SELECT value FROM ledger_state WHERE key = 'snapshot_id'")
+        self.snapshot_id = row['value'] if row else 0
+    
+    def record(self, user_id: int, amount: int, reason: str, chat_id: Optional[int] = None):
+        """Добавить проводку"""
+        self._pending.append((user_id, amount, reason, chat_id, clock.time()))
+        self._pending_sums[user_id] = self._pending_sums.get(user_id, 0) + amount
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+    
+    def flush(self):
+        """Записать накопленные проводки одной транзакцией"""
+        if not self._pending:
+            return
+            
+        pending = self._pending
+        self.db.execute_many(
+            "INSERT INTO balance_ledger (user_id, amount, reason, chat_id, created_at) VALUES (?, ?, ?, ?, ?)",
+            pending
+        )
+        self._pending = []
+        self._pending_sums = {}
+    
+    def unapplied(self, user_id: int) -> int:
+        """Сумма проводок игрока, еще не перенесенных в users.balance"""
+        row = self.db.fetch_one(
+            "SELECT COALESCE(SUM(amount), 0) AS total FROM balance_ledger WHERE user_id = ? AND id > ?",
+            (user_id, self.snapshot_id)
+        )
+        return row['total'] + self._pending_sums.get(user_id, 0)
+    
+    def snapshot(self) -> int:
+        """Перенести новые проводки в балансы. Возвращает число перенесенных проводок"""
+        self.flush()
+        row = self.db.fetch_one("SELECT MAX(id) AS last_id FROM balance_ledger")
+        last_id = row['last_id'] or 0
+        if last_id <= self.snapshot_id:
+            return 0
+            
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE users SET balance = balance + (
+                    SELECT SUM(amount) FROM balance_ledger l
+                    WHERE l.user_id = users.user_id AND l.id > ? AND l.id <= ?
+                )
+                WHERE user_id IN (SELECT user_id FROM balance_ledger WHERE id > ? AND id <= ?)
+            ''', (self.snapshot_id, last_id, self.snapshot_id, last_id))
+            cursor.execute(
+                "INSERT OR REPLACE INTO ledger_state (key, value) VALUES ('snapshot_id', ?)",
+                (last_id,)
+            )
+            
+        applied = last_id - self.snapshot_id
+        self.snapshot_id = last_id
+        return applied
+    
+    def history(self, user_id: int, limit: int = 10) -> List[Tuple[int, str, float]]:
+        """Последние проводки игрока: (сумма, причина, время)"""
+        pending = [
+            (amount, reason, created_at)
+            for pending_user, amount, reason, _, created_at in reversed(self._pending)
+            if pending_user == user_id
+        ]
+        rows = self.db.fetch_all(
+            "SELECT amount, reason, created_at FROM balance_ledger WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        )
+        entries = pending + [(row['amount'], row['reason'], row['created_at']) for row in rows]
+        # Пакетные начисления пишутся в БД сразу, поэтому порядок восстанавливаем по времени
+        return sorted(entries, key=lambda entry: entry[2], reverse=True)[:limit]
 
 # ==================== ИГРОВЫЕ КЛАССЫ ====================
 class GameState:
@@ -189,62 +689,87 @@ class GameState:
     
     def __init__(self, user_id: int):
         self.db = Database()
+        self.ledger = BalanceLedger()
+        self.economy = ChatEconomy()
         self.user_id = user_id
         
-    def get_user(self):
-        row = self.db.fetch_one("SELECT * FROM users WHERE user_id = ?", (self.user_id,))
-        if not row:
+    def get_user(self) -> User:
+        user = self.db.fetch_record(User, self.user_id)
+        if not user:
             self.db.execute(
-                "INSERT INTO users (user_id, balance, health, energy, happiness) VALUES (?, 1000, 100, 100, 100)",
+                "INSERT INTO users (user_id, balance, health, energy, happiness, created_at) "
+                "VALUES (?, 1000, 100, 100, 100, clock_now())",
                 (self.user_id,)
             )
-            row = self.db.fetch_one("SELECT * FROM users WHERE user_id = ?", (self.user_id,))
-        return dict(row)
+            self.economy.player_created(self.user_id, 1000, 100)
+            user = self.db.fetch_record(User, self.user_id)
+        # Баланс в таблице - последний снимок, добавляем проводки после него
+        user.balance += self.ledger.unapplied(self.user_id)
+        return user
     
-    def get_properties(self):
-        row = self.db.fetch_one("SELECT * FROM user_properties WHERE user_id = ?", (self.user_id,))
-        if not row:
+    def get_properties(self) -> Properties:
+        props = self.db.fetch_record(Properties, self.user_id)
+        if not props:
             self.db.execute(
                 "INSERT INTO user_properties (user_id) VALUES (?)",
                 (self.user_id,)
             )
-            row = self.db.fetch_one("SELECT * FROM user_properties WHERE user_id = ?", (self.user_id,))
-        return dict(row)
+            props = self.db.fetch_record(Properties, self.user_id)
+        return props
     
-    def get_server(self):
-        row = self.db.fetch_one("SELECT * FROM servers WHERE user_id = ?", (self.user_id,))
-        if not row:
+    def get_server(self) -> Server:
+        server = self.db.fetch_record(Server, self.user_id)
+        if not server:
             self.db.execute(
-                "INSERT INTO servers (user_id, level, income) VALUES (?, 1, 10)",
+                "INSERT INTO servers (user_id, level, income, last_collected) VALUES (?, 1, 10, clock_now())",
                 (self.user_id,)
             )
-            row = self.db.fetch_one("SELECT * FROM servers WHERE user_id = ?", (self.user_id,))
-        return dict(row)
+            self.economy.set_player(self.user_id, server_level=1)
+            server = self.db.fetch_record(Server, self.user_id)
+        return server
     
-    def get_job(self):
-        row = self.db.fetch_one("SELECT * FROM jobs WHERE user_id = ?", (self.user_id,))
-        if not row:
+    def get_job(self) -> Job:
+        job = self.db.fetch_record(Job, self.user_id)
+        if not job:
             self.db.execute(
-                "INSERT INTO jobs (user_id, job_type, salary) VALUES (?, 'безработный', 0)",
+                "INSERT INTO jobs (user_id, job_type, salary, last_worked) VALUES (?, 'безработный', 0, clock_now())",
                 (self.user_id,)
             )
-            row = self.db.fetch_one("SELECT * FROM jobs WHERE user_id = ?", (self.user_id,))
-        return dict(row)
+            job = self.db.fetch_record(Job, self.user_id)
+        return job
     
-    def update_balance(self, amount: int):
+    def update_balance(self, amount: int, reason: str = "прочее", chat_id: Optional[int] = None):
         user = self.get_user()
-        new_balance = user['balance'] + amount
-        self.db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, self.user_id))
-        return new_balance
+        self.ledger.record(self.user_id, amount, reason, chat_id)
+        self.economy.add_money(self.user_id, amount)
+        return user.balance + amount
     
     def update_stat(self, stat: str, amount: int):
         """Обновить здоровье, энергию или счастье"""
         user = self.get_user()
-        current = user.get(stat, 100)
+        current = getattr(user, stat)
         new_value = max(0, min(100, current + amount))
         self.db.execute(f"UPDATE users SET {stat} = ? WHERE user_id = ?", (new_value, self.user_id))
+        if stat == "health":
+            self.economy.set_player(self.user_id, health=new_value)
         return new_value
     
+    def set_job(self, job_type: str, salary: int, stress_level: int):
+        self.get_job()
+        self.db.execute(
+            "UPDATE jobs SET job_type = ?, salary = ?, stress_level = ? WHERE user_id = ?",
+            (job_type, salary, stress_level, self.user_id)
+        )
+        self.economy.set_player(self.user_id, employed=int(salary > 0))
+    
+    def upgrade_server(self, level: int, income: int):
+        self.get_server()
+        self.db.execute(
+            "UPDATE servers SET level = ?, income = ? WHERE user_id = ?",
+            (level, income, self.user_id)
+        )
+        self.economy.set_player(self.user_id, server_level=level)
+    
     def add_to_inventory(self, item_type: str, quantity: int = 1):
         self.db.execute('''
             INSERT OR REPLACE INTO inventory (user_id, item_type, quantity)
@@ -253,7 +778,8 @@ class GameState:
     
     def log_event(self, chat_id: int, event_type: str, message: str):
         self.db.execute(
-            "INSERT INTO events_log (chat_id, user_id, event_type, message) VALUES (?, ?, ?, ?)",
+            "INSERT INTO events_log (chat_id, user_id, event_type, message, created_at) "
+            "VALUES (?, ?, ?, ?, clock_now())",
             (chat_id, self.user_id, event_type, message)
         )
 
@@ -285,56 +811,152 @@ class GameEngine:
         ("учитель", 280, 10)
     ]
     
+    QUIZ_REWARD_RANGE = (30, 70)
+    
+    # (тип, текст, показатель, знак, минимум, максимум)
+    RANDOM_EVENTS = [
+        ("удача", "Вы нашли деньги на улице!", "balance", 1, 50, 200),
+        ("болезнь", "Вы простудились...", "health", -1, 10, 30),
+        ("усталость", "Переработали...", "energy", -1, 20, 40),
+        ("радость", "Встретили старого друга!", "happiness", 1, 10, 30),
+        ("проблема", "Сломалась машина", "balance", -1, 100, 300),
+        ("доход", "Сервер принес прибыль", "balance", 1, 20, 100),
+        ("скандал", "Девушка обиделась...", "happiness", -1, 20, 40),
+        ("питомец", "Питомец голоден!", "happiness", -1, 10, 20),
+        ("работа", "Получили премию!", "balance", 1, 200, 500),
+        ("отдых", "Хорошо отдохнули", "energy", 1, 20, 40)
+    ]
+    
+    # (показатель, шанс ухудшения, минимум, максимум)
+    DECAY_RULES = [
+        ("health", 0.3, 1, 5),
+        ("energy", 0.4, 2, 8),
+        ("happiness", 0.3, 1, 6)
+    ]
+    GIRLFRIEND_DECAY = (0.2, 5, 15)
+    PET_HUNGER = (0.3, 10, 30)
+    
     @staticmethod
-    def create_quiz(chat_id: int) -> dict:
-        """Создать новую викторину"""
+    def create_quizzes(chat_ids: List[int]) -> Dict[int, dict]:
+        """Создать викторины сразу для нескольких чатов одной транзакцией, закрыв предыдущие"""
         db = Database()
-        question, answer = random.choice(GameEngine.QUIZ_QUESTIONS)
-        reward = random.randint(30, 70)
-        
-        db.execute(
-            "INSERT INTO quizzes (chat_id, question, answer, reward) VALUES (?, ?, ?, ?)",
-            (chat_id, question, answer, reward)
-        )
+        quizzes = {}
+        for chat_id in chat_ids:
+            question, answer = random.choice(GameEngine.QUIZ_QUESTIONS)
+            quizzes[chat_id] = {
+                "question": question,
+                "answer": answer,
+                "reward": random.randint(*GameEngine.QUIZ_REWARD_RANGE)
+            }
+        if not quizzes:
+            return quizzes
+            
+        with db.transaction() as cursor:
+            cursor.executemany(
+                "UPDATE quizzes SET active = 0 WHERE chat_id = ? AND active = 1",
+                [(chat_id,) for chat_id in quizzes]
+            )
+            last_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM quizzes").fetchone()[0]
+            cursor.executemany(
+                "INSERT INTO quizzes (chat_id, question, answer, reward, created_at) VALUES (?, ?, ?, ?, clock_now())",
+                [(chat_id, quiz["question"], quiz["answer"], quiz["reward"]) for chat_id, quiz in quizzes.items()]
+            )
+            # В одной транзакции никто другой не пишет, поэтому новые id - все строки после last_id
+            for quiz_id, chat_id in cursor.execute("SELECT id, chat_id FROM quizzes WHERE id > ?", (last_id,)):
+                quizzes[chat_id]["quiz_id"] = quiz_id
         
-        return {
-            "question": question,
-            "answer": answer,
-            "reward": reward,
-            "quiz_id": db.cursor.lastrowid
-        }
+        return quizzes
     
     @staticmethod
-    def check_quiz_answer(quiz_id: int, user_answer: str) -> Tuple[bool, int]:
-        """Проверить ответ на викторину"""
+    def existing_players(user_ids: List[int], batch: int = 500) -> List[int]:
+        """Оставить только участников с профилем, не создавая новых"""
         db = Database()
-        quiz = db.fetch_one("SELECT * FROM quizzes WHERE id = ? AND active = 1", (quiz_id,))
-        
-        if not quiz:
-            return False, 0
-        
-        is_correct = user_answer.strip() == quiz['answer']
-        if is_correct:
-            db.execute("UPDATE quizzes SET active = 0 WHERE id = ?", (quiz_id,))
-            
-        return is_correct, quiz['reward'] if is_correct else 0
+        found = set()
+        for start in range(0, len(user_ids), batch):
+            chunk = user_ids[start:start + batch]
+            rows = db.fetch_all(
+                f"SELECT user_id FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})",
+                tuple(chunk)
+            )
+            found.update(row['user_id'] for row in rows)
+        return [user_id for user_id in user_ids if user_id in found]
     
     @staticmethod
     def get_random_event() -> Tuple[str, str, Dict]:
         """Случайное жизненное событие"""
-        events = [
-            ("удача", "Вы нашли деньги на улице!", {"balance": random.randint(50, 200)}),
-            ("болезнь", "Вы простудились...", {"health": -random.randint(10, 30)}),
-            ("усталость", "Переработали...", {"energy": -random.randint(20, 40)}),
-            ("радость", "Встретили старого друга!", {"happiness": random.randint(10, 30)}),
-            ("проблема", "Сломалась машина", {"balance": -random.randint(100, 300)}),
-            ("доход", "Сервер принес прибыль", {"balance": random.randint(20, 100)}),
-            ("скандал", "Девушка обиделась...", {"happiness": -random.randint(20, 40)}),
-            ("питомец", "Питомец голоден!", {"happiness": -random.randint(10, 20)}),
-            ("работа", "Получили премию!", {"balance": random.randint(200, 500)}),
-            ("отдых", "Хорошо отдохнули", {"energy": random.randint(20, 40)})
-        ]
-        return random.choice(events)
+        event_type, message, stat, sign, low, high = random.choice(GameEngine.RANDOM_EVENTS)
+        return event_type, message, {stat: sign * random.randint(low, high)}
+    
+    # Игроки, состоящие хотя бы в одном неспящем чате
+    ACTIVE_PLAYERS_SQL = '''
+        SELECT cu.user_id FROM chat_users cu
+        LEFT JOIN chats c ON c.chat_id = cu.chat_id
+        WHERE COALESCE(c.hibernated, 0) = 0
+    '''
+    
+    @staticmethod
+    def pay_salaries() -> List[Tuple[int, int]]:
+        """Начислить зарплату всем работающим игрокам. Возвращает (игрок, сумма)"""
+        db = Database()
+        with db.transaction() as cursor:
+            cursor.execute(f'''
+                INSERT INTO balance_ledger (user_id, amount, reason, created_at)
+                SELECT user_id, salary, 'зарплата', ? FROM jobs
+                WHERE salary > 0 AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+            ''', (clock.time(),))
+            cursor.execute(f'''
+                UPDATE users SET
+                    energy = MAX(0, energy - (SELECT stress_level FROM jobs WHERE jobs.user_id = users.user_id) / 10)
+                WHERE user_id IN (SELECT user_id FROM jobs WHERE salary > 0)
+                  AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+            ''')
+            cursor.execute(f'''
+                INSERT INTO events_log (user_id, event_type, message, created_at)
+                SELECT user_id, 'salary', 'Получена зарплата ' || salary || '₽', clock_now() FROM jobs
+                WHERE salary > 0 AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+            ''')
+            
+        rows = db.fetch_all(f'''
+            SELECT user_id, salary FROM jobs WHERE salary > 0 AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+        ''')
+        return [(row['user_id'], row['salary']) for row in rows]
+    
+    @staticmethod
+    def collect_server_income() -> List[Tuple[int, int]]:
+        """Начислить доход с серверов всем игрокам. Возвращает (игрок, сумма)"""
+        db = Database()
+        with db.transaction() as cursor:
+            cursor.execute(f'''
+                INSERT INTO balance_ledger (user_id, amount, reason, created_at)
+                SELECT user_id, income, 'доход сервера', ? FROM servers
+                WHERE income > 0 AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+            ''', (clock.time(),))
+            cursor.execute(f'''
+                UPDATE servers SET last_collected = clock_now()
+                WHERE income > 0 AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+            ''')
+            
+        rows = db.fetch_all(f'''
+            SELECT user_id, income FROM servers WHERE income > 0 AND user_id IN ({GameEngine.ACTIVE_PLAYERS_SQL})
+        ''')
+        return [(row['user_id'], row['income']) for row in rows]
+    
+    @staticmethod
+    def server_income_by_chat(chat_ids: List[int]) -> List[Tuple[int, int]]:
+        """Суммарный доход серверов участников для указанных чатов"""
+        db = Database()
+        result = []
+        # Не упираемся в лимит параметров SQLite
+        for start in range(0, len(chat_ids), 500):
+            chunk = chat_ids[start:start + 500]
+            rows = db.fetch_all(f'''
+                SELECT cu.chat_id, SUM(s.income) AS total FROM chat_users cu
+                JOIN servers s ON s.user_id = cu.user_id
+                WHERE s.income > 0 AND cu.chat_id IN ({",".join("?" * len(chunk))})
+                GROUP BY cu.chat_id
+            ''', tuple(chunk))
+            result.extend((row['chat_id'], row['total']) for row in rows)
+        return result
     
     @staticmethod
     def decay_stats(user_id: int):
@@ -342,17 +964,15 @@ class GameEngine:
         state = GameState(user_id)
         
         # Шанс ухудшения каждого показателя
-        if random.random() < 0.3:
-            state.update_stat("health", -random.randint(1, 5))
-        if random.random() < 0.4:
-            state.update_stat("energy", -random.randint(2, 8))
-        if random.random() < 0.3:
-            state.update_stat("happiness", -random.randint(1, 6))
+        for stat, chance, low, high in GameEngine.DECAY_RULES:
+            if random.random() < chance:
+                state.update_stat(stat, -random.randint(low, high))
         
         # Если есть девушка - может обидеться
         props = state.get_properties()
-        if props['has_girlfriend'] and random.random() < 0.2:
-            new_happiness = max(0, props['girlfriend_happiness'] - random.randint(5, 15))
+        chance, low, high = GameEngine.GIRLFRIEND_DECAY
+        if props.has_girlfriend and random.random() < chance:
+            new_happiness = max(0, props.girlfriend_happiness - random.randint(low, high))
             db = Database()
             db.execute(
                 "UPDATE user_properties SET girlfriend_happiness = ? WHERE user_id = ?",
@@ -361,8 +981,9 @@ class GameEngine:
             return "👫 Девушка скучает без внимания..."
         
         # Если есть питомец - хочет есть
-        if props['has_pet'] and random.random() < 0.3:
-            new_hunger = min(100, props['pet_hunger'] + random.randint(10, 30))
+        chance, low, high = GameEngine.PET_HUNGER
+        if props.has_pet and random.random() < chance:
+            new_hunger = min(100, props.pet_hunger + random.randint(low, high))
             db = Database()
             db.execute(
                 "UPDATE user_properties SET pet_hunger = ? WHERE user_id = ?",
@@ -372,6 +993,849 @@ class GameEngine:
         
         return None
 
+# ==================== ВИКТОРИНЫ ====================
+class QuizManager:
+    """Жизненный цикл викторин: не больше одной живой викторины на чат"""
+    
+    def __init__(self, timeout: int, keep_days: int = 7, sweep_batch: int = 500):
+        self.db = Database()
+        self.timeout = timeout
+        self.keep_seconds = keep_days * 86400
+        self.sweep_batch = sweep_batch
+        self.live = {}  # chat_id -> живая викторина, чтобы не ходить в БД на каждое сообщение
+    
+    def load(self):
+        """Поднять из БД викторины, которые еще принимают ответы"""
+        rows = self.db.fetch_all('''
+            SELECT id, chat_id, answer, reward, CAST(strftime('%s', created_at) AS INTEGER) AS created
+            FROM quizzes WHERE active = 1 AND created_at > datetime(?, 'unixepoch')
+        ''', (clock.time() - self.timeout,))
+        for row in rows:
+            self.live[row['chat_id']] = {
+                "quiz_id": row['id'],
+                "answer": row['answer'],
+                "reward": row['reward'],
+                "expires_at": row['created'] + self.timeout
+            }
+    
+    def start_batch(self, chat_ids: List[int]) -> Dict[int, dict]:
+        """Запустить новые викторины в чатах и сразу принимать на них ответы"""
+        quizzes = GameEngine.create_quizzes(chat_ids)
+        expires_at = clock.time() + self.timeout
+        for quiz in quizzes.values():
+            quiz["expires_at"] = expires_at
+        self.live.update(quizzes)
+        return quizzes
+    
+    def answer(self, chat_id: int, text: str) -> Tuple[bool, int]:
+        """Проверить ответ. Возвращает (верно ли, награда)"""
+        quiz = self.live.get(chat_id)
+        if not quiz:
+            return False, 0
+            
+        if quiz["expires_at"] <= clock.time():
+            # Закроет в БД ближайшая очистка
+            del self.live[chat_id]
+            return False, 0
+            
+        if text.strip() != quiz["answer"]:
+            return False, 0
+            
+        del self.live[chat_id]
+        self.db.execute("UPDATE quizzes SET active = 0 WHERE id = ?", (quiz["quiz_id"],))
+        return True, quiz["reward"]
+    
+    def expire_batch(self) -> int:
+        """Закрыть порцию просроченных викторин"""
+        now = clock.time()
+        for chat_id in [chat_id for chat_id, quiz in self.live.items() if quiz["expires_at"] <= now]:
+            del self.live[chat_id]
+            
+        cursor = self.db.execute('''
+            UPDATE quizzes SET active = 0 WHERE id IN (
+                SELECT id FROM quizzes WHERE active = 1 AND created_at <= datetime(?, 'unixepoch') LIMIT ?
+            )
+        ''', (now - self.timeout, self.sweep_batch))
+        return cursor.rowcount
+    
+    def prune_batch(self) -> int:
+        """Удалить порцию старых завершенных викторин"""
+        cursor = self.db.execute('''
+            DELETE FROM quizzes WHERE id IN (
+                SELECT id FROM quizzes WHERE active = 0 AND created_at < datetime(?, 'unixepoch') LIMIT ?
+            )
+        ''', (clock.time() - self.keep_seconds, self.sweep_batch))
+        return cursor.rowcount
+
+# ==================== ПЛАНИРОВЩИК ====================
+class ChatScheduler:
+    """Периодические задачи чатов с сохранением времени следующего запуска"""
+    
+    GLOBAL_CHAT_ID = 0  # строки расписания общих задач, не привязанных к чату
+    
+    def __init__(self, ticks: Dict[str, Tuple[int, int]], global_ticks: Dict[str, Tuple[int, int]] = None,
+                 catchup_batch: int = 50):
+        self.db = Database()
+        self.ticks = ticks  # имя задачи -> (интервал, задержка первого запуска)
+        self.global_ticks = global_ticks or {}
+        self.catchup_batch = catchup_batch
+        self._known_chats = set()
+    
+    def seed(self):
+        """Подготовить расписание при запуске"""
+        # Убираем задачи, которых больше нет, иначе они навсегда останутся просроченными
+        chat_ticks = list(self.ticks)
+        global_ticks = list(self.global_ticks)
+        self.db.execute(f'''
+            DELETE FROM chat_schedule
+            WHERE (chat_id != ? AND tick NOT IN ({",".join("?" * len(chat_ticks))}))
+               OR (chat_id = ? AND tick NOT IN ({",".join("?" * len(global_ticks))}))
+        ''', (self.GLOBAL_CHAT_ID, *chat_ticks, self.GLOBAL_CHAT_ID, *global_ticks))
+        
+        now = clock.time()
+        self.db.execute_many(
+            "INSERT OR IGNORE INTO chat_schedule (chat_id, tick, next_due) VALUES (?, ?, ?)",
+            [(self.GLOBAL_CHAT_ID, tick, now + first) for tick, (_, first) in self.global_ticks.items()]
+        )
+        
+        # Однократно переносим чаты из chat_users
+        if self.db.fetch_one("SELECT 1 FROM chat_schedule WHERE chat_id != ? LIMIT 1", (self.GLOBAL_CHAT_ID,)):
+            return
+            
+        for tick, (interval, _) in self.ticks.items():
+            # Разносим первые запуски по всему интервалу, чтобы не было залпа
+            self.db.execute('''
+                INSERT OR IGNORE INTO chat_schedule (chat_id, tick, next_due)
+                SELECT DISTINCT chat_id, ?, ? + abs(random() % ?) FROM chat_users
+            ''', (tick, now, interval))
+        logger.info("Расписание чатов заполнено из chat_users")
+    
+    def register_chat(self, chat_id: int):
+        """Добавить чат в расписание, если его там еще нет"""
+        if chat_id in self._known_chats:
+            return
+            
+        now = clock.time()
+        self.db.execute_many(
+            "INSERT OR IGNORE INTO chat_schedule (chat_id, tick, next_due) VALUES (?, ?, ?)",
+            [(chat_id, tick, now + first) for tick, (_, first) in self.ticks.items()]
+        )
+        self._known_chats.add(chat_id)
+    
+    def reschedule(self, chat_id: int, tick: str, delay: int):
+        """Перенести следующий запуск задачи чата"""
+        self.db.execute(
+            "UPDATE chat_schedule SET next_due = ? WHERE chat_id = ? AND tick = ?",
+            (clock.time() + delay, chat_id, tick)
+        )
+    
+    def suspend_chat(self, chat_id: int):
+        """Остановить все задачи чата"""
+        # NULL не попадает в выборку по next_due, поэтому спящие чаты
+        # не замедляют проверку расписания
+        self.db.execute("UPDATE chat_schedule SET next_due = NULL WHERE chat_id = ?", (chat_id,))
+    
+    def resume_chat(self, chat_id: int):
+        """Возобновить задачи чата с обычными задержками первого запуска"""
+        now = clock.time()
+        self.db.execute_many(
+            "UPDATE chat_schedule SET next_due = ? WHERE chat_id = ? AND tick = ? AND next_due IS NULL",
+            [(now + first, chat_id, tick) for tick, (_, first) in self.ticks.items()]
+        )
+    
+    def pop_due(self) -> List[Tuple[int, str]]:
+        """Забрать наступившие задачи и сдвинуть их на следующий интервал"""
+        now = clock.time()
+        rows = self.db.fetch_all(
+            "SELECT chat_id, tick, next_due FROM chat_schedule WHERE next_due <= ? ORDER BY next_due LIMIT ?",
+            (now, self.catchup_batch)
+        )
+        
+        due = []
+        updates = []
+        for row in rows:
+            ticks = self.global_ticks if row['chat_id'] == self.GLOBAL_CHAT_ID else self.ticks
+            interval = ticks.get(row['tick'], (None, None))[0]
+            if interval is None:
+                continue
+            # Пропущенные за время простоя интервалы не наверстываем, но сохраняем фазу чата:
+            # иначе после простоя все чаты получат один и тот же next_due и пойдут залпом
+            missed = int((now - row['next_due']) // interval) + 1
+            next_due = row['next_due'] + missed * interval
+            updates.append((next_due, row['chat_id'], row['tick']))
+            due.append((row['chat_id'], row['tick']))
+            
+        if updates:
+            self.db.execute_many(
+                "UPDATE chat_schedule SET next_due = ? WHERE chat_id = ? AND tick = ?",
+                updates
+            )
+        return due
+
+# ==================== ЖИЗНЕННЫЙ ЦИКЛ ЧАТОВ ====================
+class ChatLifecycle:
+    """Отслеживание активности чатов и их усыпление"""
+    
+    def __init__(self, idle_seconds: int):
+        self.db = Database()
+        self.idle_seconds = idle_seconds
+        self._seen = {}  # chat_id -> время последнего апдейта, еще не записанное в БД
+        self._hibernated = {
+            row['chat_id'] for row in self.db.fetch_all("SELECT chat_id FROM chats WHERE hibernated = 1")
+        }
+    
+    def seed(self):
+        """Однократно перенести чаты из chat_users в таблицу чатов"""
+        if self.db.fetch_one("SELECT 1 FROM chats LIMIT 1"):
+            return
+        self.db.execute(
+            "INSERT OR IGNORE INTO chats (chat_id, last_activity) SELECT DISTINCT chat_id, ? FROM chat_users",
+            (clock.time(),)
+        )
+    
+    def is_hibernated(self, chat_id: int) -> bool:
+        return chat_id in self._hibernated
+    
+    def touch(self, chat_id: int) -> bool:
+        """Отметить активность чата. Возвращает True, если чат проснулся"""
+        self._seen[chat_id] = clock.time()
+        if chat_id not in self._hibernated:
+            return False
+            
+        self._hibernated.discard(chat_id)
+        self.db.execute("UPDATE chats SET hibernated = 0 WHERE chat_id = ?", (chat_id,))
+        logger.info(f"Чат {chat_id} проснулся")
+        return True
+    
+    def hibernate(self, chat_ids: List[int], reason: str):
+        """Усыпить чаты"""
+        chat_ids = [chat_id for chat_id in chat_ids if chat_id not in self._hibernated]
+        if not chat_ids:
+            return
+            
+        now = clock.time()
+        self.db.execute_many('''
+            INSERT INTO chats (chat_id, last_activity, hibernated) VALUES (?, ?, 1)
+            ON CONFLICT(chat_id) DO UPDATE SET hibernated = 1
+        ''', [(chat_id, now) for chat_id in chat_ids])
+        self._hibernated.update(chat_ids)
+        logger.info(f"Усыплено чатов: {len(chat_ids)} ({reason})")
+    
+    def flush(self):
+        """Записать накопленную активность одной пачкой"""
+        if not self._seen:
+            return
+            
+        seen, self._seen = self._seen, {}
+        self.db.execute_many('''
+            INSERT INTO chats (chat_id, last_activity) VALUES (?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET last_activity = excluded.last_activity
+        ''', list(seen.items()))
+    
+    def find_idle(self) -> List[int]:
+        """Чаты без активности дольше допустимого"""
+        rows = self.db.fetch_all(
+            "SELECT chat_id FROM chats WHERE hibernated = 0 AND last_activity < ?",
+            (clock.time() - self.idle_seconds,)
+        )
+        return [row['chat_id'] for row in rows]
+
+# ==================== АКТИВНОСТЬ ИГРОКОВ ====================
+class ActivityTracker:
+    """Последняя активность игроков в чатах с пакетной записью в БД"""
+    
+    def __init__(self):
+        self.db = Database()
+        self._seen = {}  # (chat_id, user_id) -> время последнего апдейта
+        self._names = {}  # user_id -> отображаемое имя
+    
+    def touch(self, chat_id: int, user_id: int, name: Optional[str]):
+        self._seen[(chat_id, user_id)] = clock.time()
+        if name:
+            self._names[user_id] = name
+    
+    def flush(self):
+        """Записать накопленную активность одной транзакцией"""
+        if not self._seen and not self._names:
+            return
+            
+        seen, self._seen = self._seen, {}
+        names, self._names = self._names, {}
+        with self.db.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO chat_users (chat_id, user_id, last_active) VALUES (?, ?, datetime(?, 'unixepoch'))
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET last_active = excluded.last_active
+            ''', [(chat_id, user_id, seen_at) for (chat_id, user_id), seen_at in seen.items()])
+            # Только имена существующих игроков: профиль создает GameState.get_user
+            cursor.executemany(
+                "UPDATE users SET username = ? WHERE user_id = ?",
+                [(name, user_id) for user_id, name in names.items()]
+            )
+
+# ==================== СОСТАВ ЧАТОВ ====================
+class _RosterChat:
+    """Участники одного чата: отсортированные id и время активности в параллельных массивах"""
+    __slots__ = ("ids", "seen")
+    
+    def __init__(self):
+        self.ids = array('q')
+        self.seen = array('d')
+
+
+class ChatRoster:
+    """Индекс состава чатов в памяти для периодических задач"""
+    
+    def __init__(self, compact_min: int = 1024):
+        self.db = Database()
+        self.compact_min = compact_min
+        self._chats = {}  # chat_id -> _RosterChat
+        # Обратный индекс игрок -> чаты в общих массивах (CSR): чаты игрока _users[i]
+        # лежат в _user_chats[_offsets[i]:_offsets[i + 1]]
+        self._users = array('q')
+        self._offsets = array('q', [0])
+        self._user_chats = array('q')
+        self._recent = {}  # user_id -> [chat_id], добавленные после последней упаковки
+        self._recent_count = 0
+    
+    def load(self):
+        """Построить индекс из chat_users одним проходом"""
+        # Порядок первичного ключа: участники каждого чата приходят уже отсортированными
+        cursor = self.db.conn.execute(
+            "SELECT chat_id, user_id, CAST(strftime('%s', last_active) AS REAL) FROM chat_users ORDER BY chat_id, user_id"
+        )
+        for chat_id, user_id, seen in cursor:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _RosterChat()
+            chat.ids.append(user_id)
+            chat.seen.append(seen or 0.0)
+        self._compact()
+        logger.info(f"Состав чатов загружен: {len(self._chats)} чатов, {len(self._users)} игроков")
+    
+    def _compact(self):
+        """Пересобрать обратный индекс из составов чатов"""
+        pairs = sorted((user_id, chat_id) for chat_id, chat in self._chats.items() for user_id in chat.ids)
+        users = array('q')
+        offsets = array('q')
+        for index, (user_id, _) in enumerate(pairs):
+            if not users or users[-1] != user_id:
+                users.append(user_id)
+                offsets.append(index)
+        offsets.append(len(pairs))
+        self._users = users
+        self._offsets = offsets
+        self._user_chats = array('q', (chat_id for _, chat_id in pairs))
+        self._recent = {}
+        self._recent_count = 0
+    
+    def add(self, chat_id: int, user_id: int, seen: Optional[float] = None) -> bool:
+        """Добавить участника или обновить время его активности. True - новый участник"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _RosterChat()
+            
+        seen = clock.time() if seen is None else seen
+        position = bisect.bisect_left(chat.ids, user_id)
+        if position < len(chat.ids) and chat.ids[position] == user_id:
+            if seen > chat.seen[position]:
+                chat.seen[position] = seen
+            return False
+            
+        chat.ids.insert(position, user_id)
+        chat.seen.insert(position, seen)
+        # Новые участия копятся отдельно и раз в несколько тысяч переносятся в общие массивы
+        self._recent.setdefault(user_id, []).append(chat_id)
+        self._recent_count += 1
+        if self._recent_count > max(self.compact_min, len(self._user_chats) // 8):
+            self._compact()
+        return True
+    
+    def members(self, chat_id: int) -> array:
+        chat = self._chats.get(chat_id)
+        return chat.ids if chat else array('q')
+    
+    def active_members(self, chat_id: int, since: float):
+        """Участники, активные после since"""
+        chat = self._chats.get(chat_id)
+        if not chat:
+            return
+        for user_id, seen in zip(chat.ids, chat.seen):
+            if seen > since:
+                yield user_id
+    
+    def random_member(self, chat_id: int) -> Optional[int]:
+        chat = self._chats.get(chat_id)
+        return random.choice(chat.ids) if chat and chat.ids else None
+    
+    def chats_of(self, user_id: int) -> array:
+        index = bisect.bisect_left(self._users, user_id)
+        if index < len(self._users) and self._users[index] == user_id:
+            chats = self._user_chats[self._offsets[index]:self._offsets[index + 1]]
+        else:
+            chats = array('q')
+        recent = self._recent.get(user_id)
+        if recent:
+            chats.extend(recent)
+        return chats
+
+# ==================== СТАТИСТИКА ЧАТОВ ====================
+class _ChatStats:
+    """Агрегаты экономики одного чата"""
+    __slots__ = ("players", "money", "health", "employed", "servers")
+    
+    def __init__(self):
+        self.players = 0
+        self.money = 0
+        self.health = 0  # сумма здоровья, среднее считается при показе
+        self.employed = 0
+        self.servers = {}  # уровень сервера -> число серверов
+
+
+class ChatEconomy:
+    """Счетчики экономики чатов, обновляемые вместе с состоянием игроков"""
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.init_economy()
+        return cls._instance
+    
+    def init_economy(self):
+        self.db = Database()
+        self.ledger = BalanceLedger()
+        self.roster = None  # ChatRoster задает бот, без него счетчики не ведутся
+        self._chats = {}  # chat_id -> _ChatStats
+        self._players = {}  # user_id -> [деньги, здоровье, работает, уровень сервера]
+    
+    def _chats_of(self, user_id: int):
+        return self.roster.chats_of(user_id) if self.roster else ()
+    
+    def _apply(self, chat_id: int, player: list, sign: int):
+        """Добавить (sign=1) или убрать (sign=-1) вклад игрока в статистику чата"""
+        stats = self._chats.get(chat_id)
+        if stats is None:
+            stats = self._chats[chat_id] = _ChatStats()
+        money, health, employed, server_level = player
+        stats.players += sign
+        stats.money += sign * money
+        stats.health += sign * health
+        stats.employed += sign * employed
+        if server_level:
+            count = stats.servers.get(server_level, 0) + sign
+            if count:
+                stats.servers[server_level] = count
+            else:
+                stats.servers.pop(server_level, None)
+    
+    def _load_player(self, user_id: int) -> Optional[list]:
+        row = self.db.fetch_one('''
+            SELECT u.balance, u.health, COALESCE(j.salary, 0) > 0 AS employed, COALESCE(s.level, 0) AS level
+            FROM users u
+            LEFT JOIN jobs j ON j.user_id = u.user_id
+            LEFT JOIN servers s ON s.user_id = u.user_id
+            WHERE u.user_id = ?
+        ''', (user_id,))
+        if not row:
+            return None
+        return [row['balance'] + self.ledger.unapplied(user_id), row['health'], row['employed'], row['level']]
+    
+    def join(self, chat_id: int, user_id: int):
+        """Игрок появился в чате"""
+        player = self._players.get(user_id)
+        if player is None:
+            player = self._load_player(user_id)
+            if player is None:
+                # Профиля еще нет: участие уже в составе чатов, player_created учтет его там
+                return
+            self._players[user_id] = player
+        self._apply(chat_id, player, 1)
+    
+    def player_created(self, user_id: int, money: int, health: int):
+        player = self._players[user_id] = [money, health, 0, 0]
+        for chat_id in self._chats_of(user_id):
+            self._apply(chat_id, player, 1)
+    
+    def add_money(self, user_id: int, amount: int):
+        player = self._players.get(user_id)
+        if player is None:
+            return
+        player[0] += amount
+        for chat_id in self._chats_of(user_id):
+            self._chats[chat_id].money += amount
+    
+    def set_player(self, user_id: int, health: Optional[int] = None, employed: Optional[int] = None,
+                   server_level: Optional[int] = None):
+        """Новые значения показателей игрока"""
+        player = self._players.get(user_id)
+        if player is None:
+            return
+        chats = self._chats_of(user_id)
+        for chat_id in chats:
+            self._apply(chat_id, player, -1)
+        if health is not None:
+            player[1] = health
+        if employed is not None:
+            player[2] = employed
+        if server_level is not None:
+            player[3] = server_level
+        for chat_id in chats:
+            self._apply(chat_id, player, 1)
+    
+    def stats(self, chat_id: int) -> Optional[_ChatStats]:
+        return self._chats.get(chat_id)
+    
+    def recompute(self) -> int:
+        """Пересчитать все счетчики по БД. Возвращает число чатов, где они разошлись"""
+        if self.roster is None:
+            return 0
+        # После снимка users.balance содержит все проводки
+        self.ledger.snapshot()
+        previous = self._chats
+        self._chats = {}
+        self._players = {}
+        cursor = self.db.conn.execute('''
+            SELECT u.user_id, u.balance, u.health, COALESCE(j.salary, 0) > 0, COALESCE(s.level, 0)
+            FROM users u
+            LEFT JOIN jobs j ON j.user_id = u.user_id
+            LEFT JOIN servers s ON s.user_id = u.user_id
+        ''')
+        for user_id, money, health, employed, server_level in cursor:
+            chats = self._chats_of(user_id)
+            if not chats:
+                continue
+            player = self._players[user_id] = [money, health, employed, server_level]
+            for chat_id in chats:
+                self._apply(chat_id, player, 1)
+                
+        drifted = 0
+        for chat_id, stats in self._chats.items():
+            old = previous.get(chat_id)
+            if old is None or (old.players, old.money, old.health, old.employed, old.servers) != (
+                    stats.players, stats.money, stats.health, stats.employed, stats.servers):
+                drifted += 1
+        return drifted
+
+# ==================== РЕЗЕРВНОЕ КОПИРОВАНИЕ ====================
+class BackupManager:
+    """Онлайн-резервное копирование БД небольшими порциями страниц"""
+    
+    def __init__(self, directory: str, pages_per_step: int = 64, step_pause: float = 0.05,
+                 compress: bool = True, keep: int = 7):
+        self.db = Database()
+        self.directory = directory
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+        self.compress = compress
+        self.keep = keep
+        self.progress = None  # (скопировано страниц, всего страниц) во время копирования
+        self._lock = threading.Lock()
+    
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+    
+    def run(self) -> str:
+        """Сделать снимок БД. Блокирующий вызов для фонового потока"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Резервное копирование уже выполняется")
+            
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(self.directory, f"kotak_db-{stamp}.sqlite")
+            part_path = path + ".part"
+            started = time.monotonic()
+            
+            # Копируем через основное соединение: его собственные записи во время
+            # копирования попадают в снимок, и копирование не перезапускается.
+            # Блокировка берется только на время одного шага
+            target = sqlite3.connect(part_path)
+            try:
+                self.progress = (0, 0)
+                self.db.conn.backup(target, pages=self.pages_per_step, progress=self._on_progress)
+            finally:
+                target.close()
+                
+            if self.compress:
+                with open(part_path, 'rb') as src, gzip.open(path + ".gz", 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.remove(part_path)
+                path += ".gz"
+            else:
+                os.replace(part_path, path)
+                
+            self._prune()
+            logger.info(
+                f"Резервная копия {path} готова за {time.monotonic() - started:.1f} с "
+                f"({os.path.getsize(path) // 1024} КБ)"
+            )
+            return path
+        finally:
+            self.progress = None
+            self._lock.release()
+    
+    def _on_progress(self, status: int, remaining: int, total: int):
+        copied = total - remaining
+        previous = self.progress[0] if self.progress else 0
+        self.progress = (copied, total)
+        # В лог пишем примерно каждые 10%
+        if total and (copied * 10 // total) != (previous * 10 // total):
+            logger.info(f"Резервное копирование: {copied}/{total} страниц")
+        if remaining:
+            time.sleep(self.step_pause)
+    
+    def _prune(self):
+        """Удалить старые копии сверх лимита"""
+        if self.keep <= 0:
+            return
+            
+        backups = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith("kotak_db-") and not name.endswith(".part")
+        )
+        for name in backups[:-self.keep]:
+            os.remove(os.path.join(self.directory, name))
+
+# ==================== ОБСЛУЖИВАНИЕ БД ====================
+class StorageMaintenance:
+    """Обслуживание файла БД небольшими шагами в фоновом потоке"""
+    
+    def __init__(self, budget: float = 0.2, vacuum_pages: int = 64,
+                 optimize_interval: float = 3600, integrity_interval: float = 86400):
+        self.budget = budget
+        self.vacuum_pages = vacuum_pages
+        self.optimize_interval = optimize_interval
+        self.integrity_interval = integrity_interval
+        self.metrics = {}  # показатель -> последнее значение
+        self._conn = None
+        self._lock = threading.Lock()
+        self._next_optimize = 0.0
+        self._next_integrity = 0.0
+        self._analyze_tables = []  # таблицы без статистики, ожидающие ANALYZE
+        self._integrity_tables = []  # таблицы, оставшиеся в текущей проверке целостности
+        self._integrity_errors = []
+        self._vacuum_warned = False
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Отдельное соединение, чтобы не вклиниваться в транзакции бота
+            self._conn = sqlite3.connect(Database.db_file, timeout=1, check_same_thread=False)
+        return self._conn
+    
+    def run_step(self) -> Dict[str, int]:
+        """Один шаг обслуживания в пределах бюджета. Блокирующий вызов для фонового потока"""
+        if not self._lock.acquire(blocking=False):
+            return {}
+        try:
+            started = time.monotonic()
+            deadline = started + self.budget
+            conn = self._connection()
+            done = {}
+            
+            # PASSIVE не ждет читателей и писателей; WAL переиспользуется после полного переноса
+            _, wal_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if checkpointed > 0 and checkpointed != self.metrics.get("wal_checkpointed"):
+                done["checkpointed"] = checkpointed
+            self.metrics["wal_frames"] = max(wal_frames, 0)
+            self.metrics["wal_checkpointed"] = max(checkpointed, 0)
+                
+            vacuumed = self._vacuum(conn, deadline)
+            if vacuumed:
+                done["vacuumed"] = vacuumed
+                self.metrics["vacuumed_total"] = self.metrics.get("vacuumed_total", 0) + vacuumed
+                
+            now = clock.time()
+            analyzed = self._optimize(conn, deadline, now)
+            if analyzed:
+                done["analyzed"] = analyzed
+            if now >= self._next_optimize and not self._analyze_tables and time.monotonic() < deadline:
+                # 0x10000 - проверить все таблицы, а не только те, что читало это соединение
+                # (оно выполняет только PRAGMA, и простой optimize ничего бы не делал)
+                conn.execute("PRAGMA optimize(0x10002)")
+                self._next_optimize = now + self.optimize_interval
+                self.metrics["optimized_at"] = now
+                done["optimized"] = 1
+                
+            self._check_integrity(conn, deadline, now)
+            
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            self.metrics["db_bytes"] = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+            self.metrics["freelist_pages"] = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            self.metrics["step_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return done
+        finally:
+            self._lock.release()
+    
+    def _vacuum(self, conn: sqlite3.Connection, deadline: float) -> int:
+        """Вернуть свободные страницы файлу порциями, пока есть время"""
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if not self._vacuum_warned:
+                logger.warning("В БД выключен auto_vacuum=INCREMENTAL: выполните python main.py vacuum при остановленном боте")
+                self._vacuum_warned = True
+            return 0
+            
+        vacuumed = 0
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free and time.monotonic() < deadline:
+            conn.execute(f"PRAGMA incremental_vacuum({min(free, self.vacuum_pages)})").fetchall()
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if remaining >= free:
+                break
+            vacuumed += free - remaining
+            free = remaining
+        return vacuumed
+    
+    def _optimize(self, conn: sqlite3.Connection, deadline: float, now: float) -> int:
+        """ANALYZE таблиц с индексами, но без статистики, по одной за раз"""
+        if not self._analyze_tables:
+            if now < self._next_optimize:
+                return 0
+            query = "SELECT DISTINCT tbl_name FROM sqlite_master WHERE type = 'index' AND tbl_name NOT LIKE 'sqlite_%'"
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+                query += " AND tbl_name NOT IN (SELECT tbl FROM sqlite_stat1)"
+            self._analyze_tables = [row[0] for row in conn.execute(query + " ORDER BY tbl_name")]
+            
+        # analysis_limit ограничивает ANALYZE выборкой, чтобы шаг оставался коротким
+        conn.execute("PRAGMA analysis_limit = 400")
+        analyzed = 0
+        while self._analyze_tables and time.monotonic() < deadline:
+            conn.execute(f'ANALYZE "{self._analyze_tables.pop()}"')
+            analyzed += 1
+        return analyzed
+    
+    def _check_integrity(self, conn: sqlite3.Connection, deadline: float, now: float):
+        """Проверка целостности по одной таблице за раз; обход растягивается на несколько шагов"""
+        if not self._integrity_tables:
+            if now < self._next_integrity:
+                return
+            self._integrity_tables = [
+                row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+                )
+            ]
+            self._integrity_errors = []
+            
+        while self._integrity_tables and time.monotonic() < deadline:
+            table = self._integrity_tables.pop()
+            for (result,) in conn.execute(f'PRAGMA quick_check("{table}")'):
+                if result != "ok":
+                    self._integrity_errors.append(f"{table}: {result}")
+                    
+        if not self._integrity_tables:
+            self._next_integrity = now + self.integrity_interval
+            self.metrics["integrity_checked_at"] = now
+            self.metrics["integrity_errors"] = len(self._integrity_errors)
+            if self._integrity_errors:
+                logger.error(f"Проверка целостности БД: {'; '.join(self._integrity_errors[:10])}")
+            else:
+                logger.info("Проверка целостности БД: ok")
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def vacuum_command(args):
+    """Разовый перевод БД на incremental auto_vacuum (бот должен быть остановлен)"""
+    conn = sqlite3.connect(args.db)
+    before = os.path.getsize(args.db)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.close()
+    print(f"{args.db}: {before} -> {os.path.getsize(args.db)} байт, auto_vacuum=INCREMENTAL")
+
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+class SamplingProfiler:
+    """Выборочный профилировщик потока цикла событий, включаемый по запросу"""
+    
+    def __init__(self, directory: str, interval: float = 0.01):
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+    
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+    
+    @staticmethod
+    def _label(code) -> str:
+        name = getattr(code, "co_qualname", code.co_name)
+        return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def run(self, seconds: float, thread_id: Optional[int] = None) -> str:
+        """Снимать стеки потока в течение seconds. Блокирующий вызов для отдельного потока"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Профилирование уже выполняется")
+            
+        try:
+            thread_id = thread_id or threading.main_thread().ident
+            stacks = {}  # свернутый стек -> число выборок
+            handlers = {}  # обработчик или задача KotakBot -> число выборок
+            samples = 0
+            deadline = time.monotonic() + seconds
+            
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    codes = []
+                    while frame is not None:
+                        codes.append(frame.f_code)
+                        frame = frame.f_back
+                    codes.reverse()
+                    
+                    # Выборка относится к самому внешнему методу бота в стеке
+                    handler = "вне обработчиков"
+                    for code in codes:
+                        name = getattr(code, "co_qualname", "")
+                        if name.startswith("KotakBot.") and name not in ("KotakBot.run", "KotakBot.scheduler_job"):
+                            handler = name
+                            break
+                            
+                    stack = ";".join(self._label(code) for code in codes)
+                    stacks[stack] = stacks.get(stack, 0) + 1
+                    handlers[handler] = handlers.get(handler, 0) + 1
+                    samples += 1
+                time.sleep(self.interval)
+                
+            return self._write(stacks, handlers, samples, seconds)
+        finally:
+            self._lock.release()
+    
+    def _write(self, stacks: Dict[str, int], handlers: Dict[str, int], samples: int, seconds: float) -> str:
+        """Сохранить свернутые стеки для flamegraph и текстовую сводку"""
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"profile-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        
+        with open(base + ".folded", 'w', encoding='utf-8') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+                
+        own = {}  # функция -> выборки, где она на вершине стека
+        total = {}  # функция -> выборки, где она есть в стеке
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for name in set(frames):
+                total[name] = total.get(name, 0) + count
+        
+        def percent(count):
+            return f"{count * 100 / samples:5.1f}%" if samples else "  0.0%"
+            
+        lines = [f"Выборок: {samples} за {seconds} с", "", "По обработчикам и задачам:"]
+        lines += [f"  {percent(count)}  {name}" for name, count in sorted(handlers.items(), key=lambda item: -item[1])]
+        lines += ["", "Топ функций по собственному времени:"]
+        lines += [f"  {percent(count)}  {name}" for name, count in sorted(own.items(), key=lambda item: -item[1])[:25]]
+        lines += ["", "Топ функций по общему времени:"]
+        lines += [f"  {percent(count)}  {name}" for name, count in sorted(total.items(), key=lambda item: -item[1])[:25]]
+        with open(base + ".txt", 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+            
+        logger.info(f"Профиль сохранен: {base}.folded, {base}.txt")
+        return base
+
 # ==================== КЛАВИАТУРЫ ====================
 class Keyboards:
     """Клавиатуры для бота"""
@@ -451,24 +1915,335 @@ class Keyboards:
         ]
         return InlineKeyboardMarkup(keyboard)
 
+# ==================== ЗАПИСЬ АПДЕЙТОВ ====================
+class UpdateRecorder:
+    """Запись входящих апдейтов с обезличенными id в построчный JSON"""
+    
+    NAME_FIELDS = ("first_name", "last_name", "username", "title")
+    
+    def __init__(self, path: str, salt: str = ""):
+        self.path = path
+        self.salt = salt.encode()
+        opener = gzip.open if path.endswith(".gz") else open
+        self._file = opener(path, 'at', encoding='utf-8')
+        self.recorded = 0
+    
+    def _anonymize_id(self, value: int) -> int:
+        digest = hmac.new(self.salt, str(abs(value)).encode(), hashlib.sha256).digest()
+        anonymized = int.from_bytes(digest[:5], 'big') + 1
+        return -anonymized if value < 0 else anonymized
+    
+    def _anonymize(self, value):
+        if isinstance(value, list):
+            return [self._anonymize(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+            
+        # Пользователи и чаты узнаются по своим полям
+        is_person = "id" in value and ("first_name" in value or "type" in value)
+        result = {}
+        for key, item in value.items():
+            if isinstance(item, int) and not isinstance(item, bool) and (
+                    key in ("user_id", "chat_id") or (key == "id" and is_person)):
+                result[key] = self._anonymize_id(item)
+            elif is_person and key in self.NAME_FIELDS and isinstance(item, str):
+                result[key] = f"{key}{self._anonymize_id(value['id']) % 100000}"
+            else:
+                result[key] = self._anonymize(item)
+        return result
+    
+    def record(self, update: Update):
+        line = json.dumps(
+            {"t": round(time.time(), 3), "update": self._anonymize(update.to_dict())},
+            ensure_ascii=False,
+            separators=(",", ":")
+        )
+        self._file.write(line + "\n")
+        self.recorded += 1
+    
+    def close(self):
+        self._file.close()
+
+# ==================== СВОДКИ УВЕДОМЛЕНИЙ ====================
+class NotificationDigest:
+    """Буфер несрочных уведомлений: за окно в чат уходит одно сообщение"""
+    
+    SEPARATOR = "\n\n➖➖➖\n\n"
+    MAX_LENGTH = 4096  # лимит длины сообщения Telegram
+    
+    def __init__(self, window: float):
+        self.window = window
+        self._pending = {}  # chat_id -> {текст: сколько раз}, порядок добавления сохраняется
+        self._due = {}  # chat_id -> когда отправить
+    
+    def add(self, chat_id: int, text: str):
+        texts = self._pending.get(chat_id)
+        if texts is None:
+            texts = self._pending[chat_id] = {}
+            self._due[chat_id] = clock.time() + self.window
+        texts[text] = texts.get(text, 0) + 1
+    
+    def pop_due(self, flush_all: bool = False) -> List[Tuple[int, List[str]]]:
+        """Забрать чаты, у которых истекло окно, со склеенными сообщениями"""
+        now = clock.time()
+        due = [chat_id for chat_id, moment in self._due.items() if flush_all or moment <= now]
+        result = []
+        for chat_id in due:
+            del self._due[chat_id]
+            result.append((chat_id, self.merge(self._pending.pop(chat_id))))
+        return result
+    
+    @classmethod
+    def merge(cls, texts: Dict[str, int]) -> List[str]:
+        """Склеить уведомления в сообщения не длиннее лимита; повторы сворачиваются"""
+        items = [text if count == 1 else f"{text}\n(×{count})" for text, count in texts.items()]
+        if len(items) == 1:
+            return items
+            
+        messages = []
+        current = "📰 *Сводка КОТАК*"
+        for item in items:
+            if len(current) + len(cls.SEPARATOR) + len(item) > cls.MAX_LENGTH:
+                messages.append(current)
+                current = item
+            else:
+                current += cls.SEPARATOR + item
+        messages.append(current)
+        return messages
+    
+    def __len__(self) -> int:
+        return len(self._pending)
+
+# ==================== ОТВЕТЫ ====================
+class RenderCache:
+    """Отпечатки последнего показанного содержимого сообщений бота"""
+    
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._fingerprints = OrderedDict()  # (chat_id, message_id) -> отпечаток
+    
+    @staticmethod
+    def fingerprint(text: str, parse_mode: Optional[str] = None, reply_markup=None) -> int:
+        markup = reply_markup.to_json() if reply_markup is not None else None
+        return hash((text, parse_mode, markup))
+    
+    def is_current(self, key: Tuple[int, int], fingerprint: int) -> bool:
+        """Совпадает ли содержимое с тем, что уже показано"""
+        if self._fingerprints.get(key) != fingerprint:
+            return False
+        self._fingerprints.move_to_end(key)
+        return True
+    
+    def remember(self, key: Tuple[int, int], fingerprint: int):
+        self._fingerprints[key] = fingerprint
+        self._fingerprints.move_to_end(key)
+        if len(self._fingerprints) > self.max_size:
+            self._fingerprints.popitem(last=False)
+
 # ==================== ОСНОВНОЙ БОТ ====================
 class KotakBot:
     """Главный класс бота"""
     
     def __init__(self):
         self.db = Database()
-        self.active_quizzes = {}
         self.config = self.load_config()
+        setup_logging(self.config["logging"])
         
+        quizzes = self.config["quizzes"]
+        self.quizzes = QuizManager(
+            quizzes["timeout"],
+            keep_days=quizzes["keep_days"],
+            sweep_batch=quizzes["sweep_batch"]
+        )
+        
+        game = self.config["game"]
+        # Задачи отдельных чатов
+        self.ticks = {
+            "quiz": (self.start_quizzes, game["quiz_interval"], 10),
+            "decay": (self.decay_stats_job, game["decay_interval"], 900),
+            "events": (self.random_events_job, game["events_interval"], 1200),
+        }
+        # Экономика считается один раз на игрока, а не на каждое его членство в чате
+        self.global_ticks = {
+            "salary": (self.hourly_salary, game["salary_interval"], 60),
+            "server_income": (self.collect_server_income, game["server_interval"], 300),
+        }
+        # Задачи чатов, которые за одну проверку расписания получают сразу все наступившие чаты
+        self.batch_ticks = {"quiz"}
+        self.scheduler = ChatScheduler(
+            {name: (interval, first) for name, (_, interval, first) in self.ticks.items()},
+            {name: (interval, first) for name, (_, interval, first) in self.global_ticks.items()},
+            catchup_batch=self.config["scheduler"]["catchup_batch"]
+        )
+        self.lifecycle = ChatLifecycle(self.config["lifecycle"]["idle_days"] * 86400)
+        self.activity = ActivityTracker()
+        self.roster = ChatRoster()
+        self.render_cache = RenderCache(self.config["render_cache"]["max_size"])
+        self.digest = NotificationDigest(self.config["digest"]["window"])
+        
+        recorder = self.config["recorder"]
+        self.recorder = UpdateRecorder(recorder["path"], recorder["salt"]) if recorder["enabled"] else None
+        self.ledger = BalanceLedger()
+        self.ledger.flush_size = self.config["ledger"]["flush_size"]
+        self.economy = ChatEconomy()
+        self.economy.roster = self.roster
+        self.profiler = SamplingProfiler(
+            self.config["profiler"]["dir"],
+            interval=self.config["profiler"]["interval"]
+        )
+        
+        backup = self.config["backup"]
+        self.backup = BackupManager(
+            backup["dir"],
+            pages_per_step=backup["pages_per_step"],
+            step_pause=backup["step_pause"],
+            compress=backup["compress"],
+            keep=backup["keep"]
+        )
+        
+        maintenance = self.config["maintenance"]
+        self.maintenance = StorageMaintenance(
+            budget=maintenance["budget"],
+            vacuum_pages=maintenance["vacuum_pages"],
+            optimize_interval=maintenance["optimize_interval"],
+            integrity_interval=maintenance["integrity_interval"]
+        )
+    
     def load_config(self):
         """Загрузить или создать конфиг"""
         if os.path.exists(CONFIG_FILE):
             with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return yaml.safe_load(f)
+                loaded = yaml.safe_load(f) or {}
+        else:
+            loaded = dict(DEFAULT_CONFIG)
+            
+        # Соль своя у каждой установки: с известной солью id из записи находятся перебором.
+        # "kotak" - прежнее общее значение по умолчанию
+        recorder = loaded.get("recorder") or {}
+        if recorder.get("salt") in (None, "", "kotak"):
+            loaded["recorder"] = {**recorder, "salt": secrets.token_hex(16)}
+            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+                yaml.dump(loaded, f, allow_unicode=True)
+        return merge_config(DEFAULT_CONFIG, loaded)
+    
+    def start_profiler(self, seconds: float):
+        """Запустить профилировщик в фоновом потоке без ожидания результата"""
+        if self.profiler.running:
+            logger.info("Профилирование уже выполняется")
+            return
+        threading.Thread(target=self.profiler.run, args=(seconds,), daemon=True).start()
+    
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in self.config["admin"]["user_ids"]
+    
+    async def record_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Записать апдейт для последующего воспроизведения"""
+        try:
+            self.recorder.record(update)
+        except Exception as e:
+            logger.error(f"Ошибка записи апдейта: {e}")
+    
+    async def track_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отметить активность чата и игрока по любому входящему апдейту"""
+        chat = update.effective_chat
+        if not chat or chat.type == "private":
+            return
+            
+        # Бота удалили из чата: не тратим на него задачи до возвращения
+        member_update = update.my_chat_member
+        if member_update and member_update.new_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED):
+            self.hibernate_chats([chat.id], f"бот исключен из чата ({member_update.new_chat_member.status})")
+            return
+            
+        # Все, кто пишет в чат, попадают в его состав, поэтому чат ставится в расписание
+        self.scheduler.register_chat(chat.id)
+        if self.lifecycle.touch(chat.id):
+            self.scheduler.resume_chat(chat.id)
+            
+        user = update.effective_user
+        if user and not user.is_bot:
+            self.activity.touch(chat.id, user.id, user.username or user.full_name)
+            if self.roster.add(chat.id, user.id):
+                self.economy.join(chat.id, user.id)
+    
+    async def send_to_chat(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs):
+        """Отправить сообщение в чат, усыпляя чаты, где бот больше не нужен"""
+        try:
+            return await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except Forbidden as e:
+            reason = f"бот удален или заблокирован: {e}"
+        except BadRequest as e:
+            if "chat not found" not in str(e).lower():
+                raise
+            reason = f"чат не найден: {e}"
+            
+        self.hibernate_chats([chat_id], reason)
+        return None
+    
+    def hibernate_chats(self, chat_ids: List[int], reason: str):
+        """Усыпить чаты: снять их задачи с расписания и закрыть живые викторины"""
+        self.lifecycle.hibernate(chat_ids, reason)
+        for chat_id in chat_ids:
+            self.scheduler.suspend_chat(chat_id)
+            self.quizzes.live.pop(chat_id, None)
+    
+    async def send_bulk(self, context: ContextTypes.DEFAULT_TYPE, messages: List[Tuple[int, str]], **kwargs) -> list:
+        """Отправить сообщения в разные чаты, держа в полете не больше concurrency запросов.
+        Возвращает результат send_to_chat или исключение для каждого сообщения"""
+        concurrency = self.config["sender"]["concurrency"]
+        sent = []
+        for start in range(0, len(messages), concurrency):
+            chunk = messages[start:start + concurrency]
+            results = await asyncio.gather(
+                *(self.send_to_chat(context, chat_id, text, **kwargs) for chat_id, text in chunk),
+                return_exceptions=True
+            )
+            for (chat_id, _), result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Ошибка отправки в чат {chat_id}: {result}")
+            sent.extend(results)
+        return sent
+    
+    async def notify(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
+        """Несрочное уведомление: уйдет в чат в сводке за окно"""
+        if self.digest.window <= 0:
+            await self.send_to_chat(context, chat_id, text)
         else:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                yaml.dump(DEFAULT_CONFIG, f, allow_unicode=True)
-            return DEFAULT_CONFIG
+            self.digest.add(chat_id, text)
+    
+    async def send_digests(self, context: ContextTypes.DEFAULT_TYPE, flush_all: bool = False):
+        """Отправить сводки, у которых истекло окно"""
+        pending = [
+            (chat_id, messages) for chat_id, messages in self.digest.pop_due(flush_all)
+            if not self.lifecycle.is_hibernated(chat_id)
+        ]
+        # Чаты отправляются параллельно, а сообщения одного чата - по очереди, раундами
+        while pending:
+            results = await self.send_bulk(context, [(chat_id, messages[0]) for chat_id, messages in pending])
+            # Усыпленный (None) или упавший чат остаток сводки не получает
+            pending = [
+                (chat_id, messages[1:]) for (chat_id, messages), result in zip(pending, results)
+                if len(messages) > 1 and result is not None and not isinstance(result, Exception)
+            ]
+    
+    async def digest_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Отправить накопленные сводки уведомлений"""
+        await self.send_digests(context)
+    
+    async def edit_message(self, query, text: str, parse_mode: Optional[str] = None, reply_markup=None):
+        """Изменить сообщение с кнопками, пропуская правки без изменений"""
+        key = (query.message.chat_id, query.message.message_id)
+        fingerprint = RenderCache.fingerprint(text, parse_mode, reply_markup)
+        if self.render_cache.is_current(key, fingerprint):
+            return
+            
+        try:
+            await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except BadRequest as e:
+            # Сообщение могло быть показано до перезапуска бота
+            if "message is not modified" not in str(e).lower():
+                raise
+        self.render_cache.remember(key, fingerprint)
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start"""
@@ -484,9 +2259,12 @@ class KotakBot:
         
         # Регистрация пользователя в чате
         self.db.execute(
-            "INSERT OR REPLACE INTO chat_users (chat_id, user_id, last_active) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            "INSERT OR REPLACE INTO chat_users (chat_id, user_id, last_active) VALUES (?, ?, clock_now())",
             (update.effective_chat.id, user_id)
         )
+        if self.roster.add(update.effective_chat.id, user_id):
+            self.economy.join(update.effective_chat.id, user_id)
+        self.scheduler.register_chat(update.effective_chat.id)
         
         # Создание профиля если нет
         state = GameState(user_id)
@@ -502,7 +2280,8 @@ class KotakBot:
             f"/work - Работать\n"
             f"/shop - Магазин\n"
             f"/profile - Твой профиль\n"
-            f"/server - Твой сервер\n\n"
+            f"/server - Твой сервер\n"
+            f"/stats - Экономика чата\n\n"
             f"*Каждые 5 минут:* викторина с деньгами!\n"
             f"*Каждый час:* зарплата с работы\n"
             f"*Каждые 30 мин:* показатели падают\n\n"
@@ -537,7 +2316,8 @@ class KotakBot:
         props = state.get_properties()
         
         if data == "main_menu":
-            await query.edit_message_text(
+            await self.edit_message(
+                query,
                 "🐱 *КОТАК BOT - Главное меню*",
                 parse_mode='Markdown',
                 reply_markup=Keyboards.main_menu()
@@ -549,30 +2329,32 @@ class KotakBot:
             
             profile_text = (
                 f"👤 *Профиль {query.from_user.username or query.from_user.full_name}*\n\n"
-                f"💰 Баланс: *{user['balance']}₽*\n"
-                f"❤️ Здоровье: {user['health']}/100\n"
-                f"⚡ Энергия: {user['energy']}/100\n"
-                f"😊 Счастье: {user['happiness']}/100\n\n"
-                f"💼 Работа: *{job['job_type']}* ({job['salary']}₽/час)\n"
-                f"💻 Сервер: уровень {server['level']} (+{server['income']}₽/час)\n\n"
-                f"🏠 Недвижимость: {'Есть' if props['has_house'] else 'Нет'}\n"
-                f"🚗 Машина: {'Есть' if props['has_car'] else 'Нет'}\n"
-                f"👫 Девушка: {'Есть' if props['has_girlfriend'] else 'Нет'}\n"
-                f"🐶 Питомец: {'Есть' if props['has_pet'] else 'Нет'}\n"
-                f"💼 Бизнес: {'Есть' if props['has_business'] else 'Нет'}"
+                f"💰 Баланс: *{user.balance}₽*\n"
+                f"❤️ Здоровье: {user.health}/100\n"
+                f"⚡ Энергия: {user.energy}/100\n"
+                f"😊 Счастье: {user.happiness}/100\n\n"
+                f"💼 Работа: *{job.job_type}* ({job.salary}₽/час)\n"
+                f"💻 Сервер: уровень {server.level} (+{server.income}₽/час)\n\n"
+                f"🏠 Недвижимость: {'Есть' if props.has_house else 'Нет'}\n"
+                f"🚗 Машина: {'Есть' if props.has_car else 'Нет'}\n"
+                f"👫 Девушка: {'Есть' if props.has_girlfriend else 'Нет'}\n"
+                f"🐶 Питомец: {'Есть' if props.has_pet else 'Нет'}\n"
+                f"💼 Бизнес: {'Есть' if props.has_business else 'Нет'}"
             )
             
-            await query.edit_message_text(profile_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
+            await self.edit_message(query, profile_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
             
         elif data == "shop":
-            await query.edit_message_text(
+            await self.edit_message(
+                query,
                 "🛒 *Магазин КОТАК*\nВыберите что купить:",
                 parse_mode='Markdown',
                 reply_markup=Keyboards.shop_menu()
             )
             
         elif data == "work":
-            await query.edit_message_text(
+            await self.edit_message(
+                query,
                 "💼 *Поиск работы*\nВыберите профессию:",
                 parse_mode='Markdown',
                 reply_markup=Keyboards.work_menu()
@@ -582,12 +2364,10 @@ class KotakBot:
             job_name = data[4:]
             for job, salary, stress in GameEngine.JOBS:
                 if job == job_name:
-                    self.db.execute(
-                        "UPDATE jobs SET job_type = ?, salary = ?, stress_level = ? WHERE user_id = ?",
-                        (job_name, salary, stress, user_id)
-                    )
+                    state.set_job(job_name, salary, stress)
                     
-                    await query.edit_message_text(
+                    await self.edit_message(
+                        query,
                         f"✅ Вы устроились на работу *{job_name}*!\n"
                         f"Зарплата: *{salary}₽* в час\n"
                         f"Стресс: +{stress}% при работе\n\n"
@@ -598,129 +2378,135 @@ class KotakBot:
                     break
                     
         elif data == "buy_food":
-            if user['balance'] >= 50:
-                state.update_balance(-50)
+            if user.balance >= 50:
+                state.update_balance(-50, "еда", chat_id)
                 state.update_stat("health", 10)
                 state.update_stat("energy", 15)
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     "🍔 Вы поели! (+10❤️, +15⚡)\nБаланс: -50₽",
                     reply_markup=Keyboards.main_menu()
                 )
             else:
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     "❌ Недостаточно денег!",
                     reply_markup=Keyboards.main_menu()
                 )
                 
         elif data == "buy_medicine":
-            if user['balance'] >= 100:
-                state.update_balance(-100)
+            if user.balance >= 100:
+                state.update_balance(-100, "лекарство", chat_id)
                 state.update_stat("health", 30)
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     "💊 Вы полечились! (+30❤️)\nБаланс: -100₽",
                     reply_markup=Keyboards.main_menu()
                 )
             else:
-                await query.edit_message_text("❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
+                await self.edit_message(query, "❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
                 
         elif data == "upgrade_server":
-            if user['balance'] >= 500:
+            if user.balance >= 500:
                 server = state.get_server()
-                new_level = server['level'] + 1
-                new_income = server['income'] + 15
+                new_level = server.level + 1
+                new_income = server.income + 15
                 
-                state.update_balance(-500)
-                self.db.execute(
-                    "UPDATE servers SET level = ?, income = ? WHERE user_id = ?",
-                    (new_level, new_income, user_id)
-                )
+                state.update_balance(-500, "апгрейд сервера", chat_id)
+                state.upgrade_server(new_level, new_income)
                 
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     f"🖥️ Сервер улучшен до уровня {new_level}!\n"
                     f"Доход: +{new_income}₽ в час\n"
                     f"Баланс: -500₽",
                     reply_markup=Keyboards.main_menu()
                 )
             else:
-                await query.edit_message_text("❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
+                await self.edit_message(query, "❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
                 
         elif data == "buy_gift":
-            if not props['has_girlfriend']:
-                await query.edit_message_text("❌ У вас нет девушки!", reply_markup=Keyboards.main_menu())
+            if not props.has_girlfriend:
+                await self.edit_message(query, "❌ У вас нет девушки!", reply_markup=Keyboards.main_menu())
                 return
                 
-            if user['balance'] >= 300:
-                state.update_balance(-300)
-                new_happiness = min(100, props['girlfriend_happiness'] + 40)
+            if user.balance >= 300:
+                state.update_balance(-300, "подарок девушке", chat_id)
+                new_happiness = min(100, props.girlfriend_happiness + 40)
                 self.db.execute(
                     "UPDATE user_properties SET girlfriend_happiness = ? WHERE user_id = ?",
                     (new_happiness, user_id)
                 )
                 
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     f"🎁 Вы подарили подарок девушке!\n"
                     f"Ее настроение: {new_happiness}/100\n"
                     f"Баланс: -300₽",
                     reply_markup=Keyboards.main_menu()
                 )
             else:
-                await query.edit_message_text("❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
+                await self.edit_message(query, "❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
                 
         elif data == "buy_car":
-            if props['has_car']:
-                await query.edit_message_text("❌ У вас уже есть машина!", reply_markup=Keyboards.main_menu())
+            if props.has_car:
+                await self.edit_message(query, "❌ У вас уже есть машина!", reply_markup=Keyboards.main_menu())
                 return
                 
-            if user['balance'] >= 5000:
-                state.update_balance(-5000)
+            if user.balance >= 5000:
+                state.update_balance(-5000, "машина", chat_id)
                 self.db.execute(
                     "UPDATE user_properties SET has_car = 1, car_condition = 100 WHERE user_id = ?",
                     (user_id,)
                 )
                 
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     "🚗 Поздравляем с покупкой машины!\n"
                     "Теперь вы можете быстрее добираться на работу.\n"
                     "Баланс: -5000₽",
                     reply_markup=Keyboards.main_menu()
                 )
             else:
-                await query.edit_message_text("❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
+                await self.edit_message(query, "❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
                 
         elif data == "relationships":
-            if not props['has_girlfriend']:
-                if user['balance'] >= 1000:
-                    await query.edit_message_text(
+            if not props.has_girlfriend:
+                if user.balance >= 1000:
+                    await self.edit_message(
+                        query,
                         "👫 *Знакомство с девушкой*\nСтоимость: 1000₽\n"
                         "Вы хотите познакомиться с девушкой?",
                         parse_mode='Markdown',
                         reply_markup=Keyboards.confirm_keyboard("girlfriend")
                     )
                 else:
-                    await query.edit_message_text(
+                    await self.edit_message(
+                        query,
                         "❌ Для знакомства нужно 1000₽!",
                         reply_markup=Keyboards.main_menu()
                     )
             else:
                 rel_text = (
                     f"👫 *Ваши отношения*\n\n"
-                    f"Настроение девушки: {props['girlfriend_happiness']}/100\n\n"
+                    f"Настроение девушки: {props.girlfriend_happiness}/100\n\n"
                     f"*Советы:*\n"
                     f"• Дарите подарки (+40 настроения)\n"
                     f"• Игнорирование: -5/час\n"
                     f"• При 0 настроении: она уйдет!"
                 )
-                await query.edit_message_text(rel_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
+                await self.edit_message(query, rel_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
                 
         elif data == "confirm_girlfriend":
-            if user['balance'] >= 1000:
-                state.update_balance(-1000)
+            if user.balance >= 1000:
+                state.update_balance(-1000, "знакомство", chat_id)
                 self.db.execute(
                     "UPDATE user_properties SET has_girlfriend = 1, girlfriend_happiness = 80 WHERE user_id = ?",
                     (user_id,)
                 )
                 
-                await query.edit_message_text(
+                await self.edit_message(
+                    query,
                     "👫 Поздравляем! У вас теперь есть девушка!\n"
                     "Начальное настроение: 80/100\n"
                     "Не забывайте уделять ей внимание!\n"
@@ -728,36 +2514,41 @@ class KotakBot:
                     reply_markup=Keyboards.main_menu()
                 )
             else:
-                await query.edit_message_text("❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
+                await self.edit_message(query, "❌ Недостаточно денег!", reply_markup=Keyboards.main_menu())
                 
         elif data == "server":
             server = state.get_server()
             server_text = (
                 f"💻 *Ваш сервер*\n\n"
-                f"Уровень: *{server['level']}*\n"
-                f"Доход: *+{server['income']}₽* в час\n"
-                f"Всего заработано: {server['income'] * 24 * server['level']}₽\n\n"
+                f"Уровень: *{server.level}*\n"
+                f"Доход: *+{server.income}₽* в час\n"
+                f"Всего заработано: {server.income * 24 * server.level}₽\n\n"
                 f"*Улучшение:*\n"
                 f"Стоимость: 500₽ за уровень\n"
                 f"+15₽/час за каждый уровень\n\n"
                 f"Сервер приносит деньги даже когда вы offline!"
             )
-            await query.edit_message_text(server_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
+            await self.edit_message(query, server_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
             
         elif data == "top":
+            # Балансы как в профиле: снимок плюс проводки после него
+            self.ledger.flush()
             top_users = self.db.fetch_all('''
-                SELECT u.user_id, u.balance, u.health, u.happiness 
+                SELECT u.user_id, u.health, u.happiness,
+                       u.balance + COALESCE((
+                           SELECT SUM(l.amount) FROM balance_ledger l WHERE l.user_id = u.user_id AND l.id > ?
+                       ), 0) AS balance
                 FROM users u
                 JOIN chat_users cu ON u.user_id = cu.user_id AND cu.chat_id = ?
-                ORDER BY u.balance DESC 
+                ORDER BY balance DESC 
                 LIMIT 10
-            ''', (chat_id,))
+            ''', (self.ledger.snapshot_id, chat_id))
             
             top_text = "🏆 *Топ-10 игроков чата*\n\n"
             for i, row in enumerate(top_users, 1):
                 top_text += f"{i}. ID{row['user_id']}: {row['balance']}₽ (❤️{row['health']} 😊{row['happiness']})\n"
                 
-            await query.edit_message_text(top_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
+            await self.edit_message(query, top_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
             
         elif data == "help":
             help_text = (
@@ -779,10 +2570,11 @@ class KotakBot:
                 "*Важно:* Все взаимосвязано!\n"
                 "Игнорируете что-то → будут проблемы!"
             )
-            await query.edit_message_text(help_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
+            await self.edit_message(query, help_text, parse_mode='Markdown', reply_markup=Keyboards.main_menu())
             
         elif data == "cancel":
-            await query.edit_message_text(
+            await self.edit_message(
+                query,
                 "❌ Действие отменено",
                 reply_markup=Keyboards.main_menu()
             )
@@ -796,127 +2588,83 @@ class KotakBot:
         chat_id = update.effective_chat.id
         text = update.message.text.strip()
         
-        # Проверка активных викторин
-        active_quiz = self.db.fetch_one(
-            "SELECT * FROM quizzes WHERE chat_id = ? AND active = 1 ORDER BY id DESC LIMIT 1",
-            (chat_id,)
-        )
-        
-        if active_quiz:
-            is_correct, reward = GameEngine.check_quiz_answer(active_quiz['id'], text)
-            if is_correct:
-                state = GameState(user_id)
-                new_balance = state.update_balance(reward)
-                
-                await update.message.reply_text(
-                    f"✅ {update.effective_user.full_name} ответил правильно!\n"
-                    f"🎁 Награда: +{reward}₽\n"
-                    f"💰 Новый баланс: {new_balance}₽"
-                )
-                
-                # Создаем новую викторину через 5 минут
-                context.job_queue.run_once(
-                    self.create_new_quiz,
-                    300,  # 5 минут
-                    chat_id=chat_id,
-                    data={"chat_id": chat_id}
-                )
+        # Проверка живой викторины чата
+        is_correct, reward = self.quizzes.answer(chat_id, text)
+        if is_correct:
+            state = GameState(user_id)
+            new_balance = state.update_balance(reward, "викторина", chat_id)
+            
+            await update.message.reply_text(
+                f"✅ {update.effective_user.full_name} ответил правильно!\n"
+                f"🎁 Награда: +{reward}₽\n"
+                f"💰 Новый баланс: {new_balance}₽"
+            )
+            
+            # Следующая викторина через полный интервал после ответа
+            self.scheduler.reschedule(chat_id, "quiz", self.config["game"]["quiz_interval"])
     
-    async def create_new_quiz(self, context: ContextTypes.DEFAULT_TYPE):
-        """Создать новую викторину"""
-        chat_id = context.job.data["chat_id"]
-        quiz = GameEngine.create_quiz(chat_id)
-        
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"🧠 *ВИКТОРИНА КОТАК!*\n\n{quiz['question']}\n\nПервый правильный ответ: *+{quiz['reward']}₽*",
-            parse_mode='Markdown'
-        )
+    async def start_quizzes(self, context: ContextTypes.DEFAULT_TYPE, chat_ids: List[int]):
+        """Создать викторины во всех наступивших чатах одной транзакцией"""
+        quizzes = self.quizzes.start_batch(chat_ids)
+        await self.send_bulk(context, [
+            (chat_id, f"🧠 *ВИКТОРИНА КОТАК!*\n\n{quiz['question']}\n\nПервый правильный ответ: *+{quiz['reward']}₽*")
+            for chat_id, quiz in quizzes.items()
+        ], parse_mode='Markdown')
     
     async def hourly_salary(self, context: ContextTypes.DEFAULT_TYPE):
         """Выдача зарплаты каждый час"""
-        db = Database()
-        chat_id = context.job.data["chat_id"]
+        paid_chats = set()
+        for user_id, salary in GameEngine.pay_salaries():
+            self.economy.add_money(user_id, salary)
+            paid_chats.update(self.roster.chats_of(user_id))
         
-        # Найти всех пользователей чата с работой
-        users = db.fetch_all('''
-            SELECT u.user_id, j.salary, j.stress_level 
-            FROM users u
-            JOIN jobs j ON u.user_id = j.user_id
-            JOIN chat_users cu ON u.user_id = cu.user_id AND cu.chat_id = ?
-            WHERE j.salary > 0
-        ''', (chat_id,))
-        
-        for user in users:
-            state = GameState(user['user_id'])
-            salary = user['salary']
-            
-            # Добавляем деньги
-            new_balance = state.update_balance(salary)
-            
-            # Добавляем стресс
-            user_data = state.get_user()
-            new_energy = max(0, user_data['energy'] - user['stress_level'] // 10)
-            state.update_stat("energy", new_energy - user_data['energy'])
-            
-            # Логируем
-            state.log_event(chat_id, "salary", f"Получена зарплата {salary}₽")
-        
-        if users:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="💼 *ЧАСОВАЯ ЗАРПЛАТА!*\n\nВсе работяги получили зарплату!\nНе забывайте про отдых! ⚡"
+        # Уведомления только в неспящие чаты, где кто-то получил зарплату
+        for chat_id in sorted(paid_chats):
+            if self.lifecycle.is_hibernated(chat_id):
+                continue
+            await self.notify(
+                context,
+                chat_id,
+                "💼 *ЧАСОВАЯ ЗАРПЛАТА!*\n\nВсе работяги получили зарплату!\nНе забывайте про отдых! ⚡"
             )
     
-    async def decay_stats_job(self, context: ContextTypes.DEFAULT_TYPE):
+    async def decay_stats_job(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         """Периодическое ухудшение показателей"""
-        db = Database()
-        chat_id = context.job.data["chat_id"]
-        
-        # Получаем активных пользователей чата
-        users = db.fetch_all('''
-            SELECT user_id FROM chat_users 
-            WHERE chat_id = ? AND last_active > datetime('now', '-1 day')
-        ''', (chat_id,))
-        
         messages = []
-        for user_row in users:
-            user_id = user_row['user_id']
+        # Только игроки, активные за последние сутки: в составе чата есть и те, кто не делал /start
+        active = list(self.roster.active_members(chat_id, clock.time() - 86400))
+        for user_id in GameEngine.existing_players(active):
             event_msg = GameEngine.decay_stats(user_id)
             if event_msg:
                 messages.append(event_msg)
         
         # Если есть сообщения - отправляем не чаще 1 каждые 30 мин
         if messages and random.random() < 0.3:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"⚠️ *СОБЫТИЕ КОТАК!*\n\n{random.choice(messages)}\n\nНе забывайте ухаживать за своими делами!"
+            await self.notify(
+                context,
+                chat_id,
+                f"⚠️ *СОБЫТИЕ КОТАК!*\n\n{random.choice(messages)}\n\nНе забывайте ухаживать за своими делами!"
             )
     
-    async def random_events_job(self, context: ContextTypes.DEFAULT_TYPE):
+    async def random_events_job(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         """Случайные события"""
-        chat_id = context.job.data["chat_id"]
-        
         if random.random() < 0.2:  # 20% шанс
             event_type, event_msg, effects = GameEngine.get_random_event()
             
             # Выбираем случайного пользователя из чата
             db = Database()
-            user = db.fetch_one('''
-                SELECT user_id FROM chat_users 
-                WHERE chat_id = ? 
-                ORDER BY RANDOM() LIMIT 1
-            ''', (chat_id,))
-            
-            if user:
-                state = GameState(user['user_id'])
-                username = db.fetch_one("SELECT username FROM users WHERE user_id = ?", (user['user_id'],))
-                name = username['username'] if username else f"ID{user['user_id']}"
+            user_id = self.roster.random_member(chat_id)
+            
+            # Событие достается только игроку с профилем
+            if user_id is not None and GameEngine.existing_players([user_id]):
+                state = GameState(user_id)
+                username = db.fetch_one("SELECT username FROM users WHERE user_id = ?", (user_id,))
+                name = username['username'] if username and username['username'] else f"ID{user_id}"
                 
                 # Применяем эффекты
                 result_msg = ""
                 if 'balance' in effects:
-                    new_bal = state.update_balance(effects['balance'])
+                    new_bal = state.update_balance(effects['balance'], f"событие: {event_type}", chat_id)
                     result_msg += f"💰 Баланс: {effects['balance']}₽\n"
                 if 'health' in effects:
                     new_health = state.update_stat("health", effects['health'])
@@ -928,38 +2676,32 @@ class KotakBot:
                     new_happy = state.update_stat("happiness", effects['happiness'])
                     result_msg += f"😊 Счастье: {effects['happiness']}\n"
                 
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"🎲 *СЛУЧАЙНОЕ СОБЫТИЕ!*\n\n{name}:\n{event_msg}\n\n{result_msg}"
+                await self.notify(
+                    context,
+                    chat_id,
+                    f"🎲 *СЛУЧАЙНОЕ СОБЫТИЕ!*\n\n{name}:\n{event_msg}\n\n{result_msg}"
                 )
     
     async def collect_server_income(self, context: ContextTypes.DEFAULT_TYPE):
         """Сбор дохода с серверов"""
+        for user_id, income in GameEngine.collect_server_income():
+            self.economy.add_money(user_id, income)
+        
+        # 10% шанс уведомления для каждого чата: выбираем чаты заранее,
+        # чтобы считать суммы только по ним
         db = Database()
-        chat_id = context.job.data["chat_id"]
-        
-        servers = db.fetch_all('''
-            SELECT s.user_id, s.income, u.username
-            FROM servers s
-            JOIN users u ON s.user_id = u.user_id
-            JOIN chat_users cu ON s.user_id = cu.user_id AND cu.chat_id = ?
-            WHERE s.income > 0
-        ''', (chat_id,))
-        
-        if servers:
-            total = 0
-            for server in servers:
-                state = GameState(server['user_id'])
-                state.update_balance(server['income'])
-                total += server['income']
-            
-            if random.random() < 0.1:  # 10% шанс уведомления
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"💻 *СЕРВЕРА РАБОТАЮТ!*\n\n"
-                    f"Все сервера принесли доход: +{total}₽\n"
-                    f"Улучшайте сервера для большего заработка!"
-                )
+        chats = [
+            row['chat_id'] for row in db.fetch_all("SELECT chat_id FROM chats WHERE hibernated = 0")
+            if random.random() < 0.1
+        ]
+        for chat_id, total in GameEngine.server_income_by_chat(chats):
+            await self.notify(
+                context,
+                chat_id,
+                f"💻 *СЕРВЕРА РАБОТАЮТ!*\n\n"
+                f"Все сервера принесли доход: +{total}₽\n"
+                f"Улучшайте сервера для большего заработка!"
+            )
     
     async def work_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /work - разовая работа"""
@@ -971,24 +2713,24 @@ class KotakBot:
         user = state.get_user()
         job = state.get_job()
         
-        if job['job_type'] == 'безработный':
+        if job.job_type == 'безработный':
             await update.message.reply_text(
                 "❌ Сначала устройтесь на работу через меню!"
             )
             return
             
-        if user['energy'] < 20:
+        if user.energy < 20:
             await update.message.reply_text(
-                f"😴 Слишком устали! Энергия: {user['energy']}/100\n"
+                f"😴 Слишком устали! Энергия: {user.energy}/100\n"
                 f"Отдохните или купите еду."
             )
             return
             
         # Заработок
-        salary = job['salary'] // 4  # 15 минут работы
-        stress = job['stress_level']
+        salary = job.salary // 4  # 15 минут работы
+        stress = job.stress_level
         
-        new_balance = state.update_balance(salary)
+        new_balance = state.update_balance(salary, "работа", update.effective_chat.id)
         new_energy = state.update_stat("energy", -20)
         new_happy = state.update_stat("happiness", -stress // 20)
         
@@ -1012,9 +2754,9 @@ class KotakBot:
         
         await update.message.reply_text(
             f"💻 *Ваш сервер*\n\n"
-            f"Уровень: {server['level']}\n"
-            f"Доход: +{server['income']}₽ в час\n"
-            f"Всего принес: {server['income'] * 24 * server['level']}₽\n\n"
+            f"Уровень: {server.level}\n"
+            f"Доход: +{server.income}₽ в час\n"
+            f"Всего принес: {server.income * 24 * server.level}₽\n\n"
             f"Улучшить: /menu → Сервер",
             parse_mode='Markdown'
         )
@@ -1041,72 +2783,283 @@ class KotakBot:
         
         await update.message.reply_text(
             f"👤 *Профиль {update.effective_user.full_name}*\n\n"
-            f"💰 Баланс: {user['balance']}₽\n"
-            f"❤️ Здоровье: {user['health']}/100\n"
-            f"⚡ Энергия: {user['energy']}/100\n"
-            f"😊 Счастье: {user['happiness']}/100\n\n"
+            f"💰 Баланс: {user.balance}₽\n"
+            f"❤️ Здоровье: {user.health}/100\n"
+            f"⚡ Энергия: {user.energy}/100\n"
+            f"😊 Счастье: {user.happiness}/100\n\n"
             f"Для полной информации: /menu",
             parse_mode='Markdown'
         )
     
-    def setup_jobs(self, application):
-        """Настройка периодических задач для чата"""
-        # Получаем все активные чаты
-        db = Database()
-        chats = db.fetch_all("SELECT DISTINCT chat_id FROM chat_users")
-        
-        for chat in chats:
-            chat_id = chat['chat_id']
-            
-            # Викторина каждые 5 минут
-            application.job_queue.run_repeating(
-                self.create_new_quiz,
-                interval=300,
-                first=10,
-                chat_id=chat_id,
-                data={"chat_id": chat_id}
-            )
+    async def scheduler_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Запустить наступившие задачи чатов из расписания"""
+        # Забираем порции, пока расписание не опустеет или не выйдет лимит проверки,
+        # иначе при большом числе чатов задачи копятся и уезжают все позже.
+        # Остаток после простоя разойдется по следующим проверкам
+        deadline = time.monotonic() + self.config["scheduler"]["poll_budget"]
+        batches = {}
+        for _ in range(self.config["scheduler"]["poll_batches"]):
+            due = self.scheduler.pop_due()
+            for chat_id, tick in due:
+                if tick in self.batch_ticks:
+                    batches.setdefault(tick, []).append(chat_id)
+                    continue
+                token = log_context.set({"handler": tick, "chat_id": chat_id})
+                try:
+                    if chat_id == ChatScheduler.GLOBAL_CHAT_ID:
+                        await self.global_ticks[tick][0](context)
+                    else:
+                        await self.ticks[tick][0](context, chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка задачи {tick} в чате {chat_id}: {e}")
+                finally:
+                    log_context.reset(token)
+            if len(due) < self.scheduler.catchup_batch or time.monotonic() >= deadline:
+                break
+            # Между порциями отдаем цикл событий обработке апдейтов
+            await asyncio.sleep(0)
             
-            # Зарплата каждый час
-            application.job_queue.run_repeating(
-                self.hourly_salary,
-                interval=3600,
-                first=60,
-                chat_id=chat_id,
-                data={"chat_id": chat_id}
-            )
+        # Пакетные задачи получают все наступившие за проверку чаты разом
+        for tick, chat_ids in batches.items():
+            token = log_context.set({"handler": tick})
+            try:
+                await self.ticks[tick][0](context, chat_ids)
+            except Exception as e:
+                logger.error(f"Ошибка задачи {tick} для {len(chat_ids)} чатов: {e}")
+            finally:
+                log_context.reset(token)
+    
+    async def backup_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /backup - резервная копия БД (только для админов)"""
+        if not self.is_admin(update.effective_user.id):
+            return
             
-            # Ухудшение показателей каждые 30 минут
-            application.job_queue.run_repeating(
-                self.decay_stats_job,
-                interval=1800,
-                first=900,
-                chat_id=chat_id,
-                data={"chat_id": chat_id}
-            )
+        if self.backup.running:
+            copied, total = self.backup.progress or (0, 0)
+            percent = copied * 100 // total if total else 0
+            await update.message.reply_text(f"⏳ Резервное копирование идет: {percent}% ({copied}/{total} страниц)")
+            return
             
-            # Случайные события каждые 20-40 минут
-            application.job_queue.run_repeating(
-                self.random_events_job,
-                interval=2400,
-                first=1200,
-                chat_id=chat_id,
-                data={"chat_id": chat_id}
-            )
+        await update.message.reply_text("💾 Резервное копирование запущено")
+        # Не ждем завершения в обработчике, чтобы не задерживать остальные апдейты
+        context.application.create_task(self._backup_and_report(update))
+    
+    async def _backup_and_report(self, update: Update):
+        try:
+            path = await asyncio.to_thread(self.backup.run)
+        except Exception as e:
+            logger.error(f"Ошибка резервного копирования: {e}")
+            await update.message.reply_text(f"❌ Ошибка резервного копирования: {e}")
+            return
+        await update.message.reply_text(f"✅ Резервная копия готова: {path}")
+    
+    async def profiler_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /profiler [секунды] - профилирование бота (только для админов)"""
+        if not self.is_admin(update.effective_user.id):
+            return
             
-            # Доход с серверов каждые 15 минут
-            application.job_queue.run_repeating(
-                self.collect_server_income,
-                interval=900,
-                first=300,
-                chat_id=chat_id,
-                data={"chat_id": chat_id}
-            )
+        if self.profiler.running:
+            await update.message.reply_text("⏳ Профилирование уже идет")
+            return
+            
+        seconds = self.config["profiler"]["default_seconds"]
+        if context.args and context.args[0].isdigit():
+            seconds = min(int(context.args[0]), 600)
+            
+        await update.message.reply_text(f"🔬 Профилирование на {seconds} с запущено")
+        context.application.create_task(self._profile_and_report(update, seconds))
     
-    def run(self):
-        """Запуск бота"""
-        # Создаем Application
-        application = Application.builder().token(TOKEN).build()
+    async def _profile_and_report(self, update: Update, seconds: float):
+        # Поток цикла событий запоминаем здесь: выборки снимаются именно с него
+        thread_id = threading.get_ident()
+        try:
+            base = await asyncio.to_thread(self.profiler.run, seconds, thread_id)
+        except Exception as e:
+            logger.error(f"Ошибка профилирования: {e}")
+            await update.message.reply_text(f"❌ Ошибка профилирования: {e}")
+            return
+        await update.message.reply_text(f"✅ Профиль сохранен: {base}.folded, {base}.txt")
+    
+    async def backup_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Плановая резервная копия"""
+        if self.backup.running:
+            return
+        try:
+            await asyncio.to_thread(self.backup.run)
+        except Exception as e:
+            logger.error(f"Ошибка резервного копирования: {e}")
+    
+    async def maintenance_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Шаг обслуживания БД вне цикла событий"""
+        try:
+            done = await asyncio.to_thread(self.maintenance.run_step)
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания БД: {e}")
+            return
+        if done.get("vacuumed") or done.get("optimized"):
+            logger.info(f"Обслуживание БД: {done}, размер {self.maintenance.metrics['db_bytes']} байт")
+    
+    async def storage_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /storage - состояние файла БД (только для админов)"""
+        if not self.is_admin(update.effective_user.id):
+            return
+            
+        metrics = self.maintenance.metrics
+        if not metrics:
+            await update.message.reply_text("🗄️ Обслуживание БД еще не запускалось")
+            return
+            
+        lines = ["🗄️ *Состояние БД*\n"]
+        for name, value in sorted(metrics.items()):
+            if name.endswith("_at"):
+                value = datetime.datetime.fromtimestamp(value).strftime("%d.%m %H:%M")
+            lines.append(f"{name}: {value}")
+        await update.message.reply_text("\n".join(lines))
+    
+    async def quiz_sweep_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Закрыть просроченные и удалить старые викторины небольшими порциями"""
+        expired = await self._drain(self.quizzes.expire_batch, self.quizzes.sweep_batch)
+        pruned = await self._drain(self.quizzes.prune_batch, self.quizzes.sweep_batch)
+        if expired or pruned:
+            logger.info(f"Викторины: закрыто {expired}, удалено {pruned}")
+    
+    @staticmethod
+    async def _drain(step, batch: int) -> int:
+        """Повторять пакетную операцию, пока она обрабатывает полные порции"""
+        total = 0
+        while True:
+            count = step()
+            total += count
+            if count < batch:
+                return total
+            # Отдаем управление циклу событий между порциями
+            await asyncio.sleep(0)
+    
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /history - последние движения денег"""
+        if update.effective_chat.type == "private":
+            return
+            
+        entries = self.ledger.history(update.effective_user.id)
+        if not entries:
+            await update.message.reply_text("📜 Движений по счету пока нет")
+            return
+            
+        lines = ["📜 *Последние операции*\n"]
+        for amount, reason, created_at in entries:
+            moment = datetime.datetime.fromtimestamp(created_at).strftime("%d.%m %H:%M")
+            lines.append(f"{moment}  {amount:+}₽  {reason}")
+        await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+    
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /stats - экономика чата из счетчиков в памяти"""
+        if update.effective_chat.type == "private":
+            return
+            
+        stats = self.economy.stats(update.effective_chat.id)
+        if not stats or not stats.players:
+            await update.message.reply_text("📊 В этом чате пока нет игроков")
+            return
+            
+        servers = ", ".join(
+            f"ур.{level} - {count}" for level, count in sorted(stats.servers.items())
+        ) or "нет"
+        await update.message.reply_text(
+            f"📊 *Экономика чата*\n\n"
+            f"👥 Игроков: {stats.players}\n"
+            f"💰 Всего денег: {stats.money}₽\n"
+            f"💼 Работают: {stats.employed} из {stats.players}\n"
+            f"❤️ Среднее здоровье: {stats.health / stats.players:.0f}\n"
+            f"🖥️ Серверы: {servers}",
+            parse_mode='Markdown'
+        )
+    
+    async def stats_recompute_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Пересчитать статистику чатов по БД"""
+        drifted = self.economy.recompute()
+        if drifted:
+            logger.info(f"Статистика чатов пересчитана, расхождения в {drifted} чатах")
+    
+    async def ledger_flush_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Записать накопленные проводки"""
+        self.ledger.flush()
+    
+    async def ledger_snapshot_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Перенести проводки в балансы игроков"""
+        applied = self.ledger.snapshot()
+        if applied:
+            logger.info(f"Снимок балансов: перенесено проводок {applied}")
+    
+    async def activity_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Записать накопленную активность игроков"""
+        self.activity.flush()
+    
+    def flush_state(self):
+        """Записать все буферы в БД"""
+        self.activity.flush()
+        self.lifecycle.flush()
+        self.ledger.snapshot()
+    
+    async def flush_notifications(self, application):
+        """Отправить все накопленные сводки, пока бот еще может писать"""
+        if len(self.digest):
+            await self.send_digests(CallbackContext(application), flush_all=True)
+    
+    async def shutdown(self, application):
+        """Сохранить буферы при остановке"""
+        self.flush_state()
+        self.maintenance.close()
+        if self.recorder:
+            self.recorder.close()
+    
+    async def lifecycle_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Записать активность чатов и усыпить неактивные"""
+        self.lifecycle.flush()
+        idle = self.lifecycle.find_idle()
+        if idle:
+            self.hibernate_chats(idle, "нет активности")
+    
+    def load_state(self):
+        """Подготовить расписание и in-memory состояние из БД"""
+        self.scheduler.seed()
+        self.lifecycle.seed()
+        self.quizzes.load()
+        self.roster.load()
+        self.economy.recompute()
+    
+    def periodic_jobs(self) -> List[Tuple]:
+        """Периодические задачи: (callback, интервал в секундах)"""
+        # Задачи чатов не регистрируются по отдельности: одна проверка
+        # расписания в БД запускает те, у которых наступил срок
+        jobs = [
+            (self.scheduler_job, self.config["scheduler"]["poll_interval"]),
+            (self.quiz_sweep_job, self.config["quizzes"]["sweep_interval"]),
+            (self.ledger_flush_job, self.config["ledger"]["flush_interval"]),
+            (self.ledger_snapshot_job, self.config["ledger"]["snapshot_interval"]),
+            (self.activity_job, self.config["activity"]["flush_interval"]),
+            (self.lifecycle_job, self.config["lifecycle"]["sweep_interval"]),
+            (self.stats_recompute_job, self.config["stats"]["recompute_interval"]),
+            (self.maintenance_job, self.config["maintenance"]["interval"]),
+            (self.digest_job, self.config["digest"]["flush_interval"]),
+        ]
+        if self.config["backup"]["interval"] > 0:
+            jobs.append((self.backup_job, self.config["backup"]["interval"]))
+        return jobs
+    
+    def setup_jobs(self, application):
+        """Настройка периодических задач"""
+        self.load_state()
+        for callback, interval in self.periodic_jobs():
+            application.job_queue.run_repeating(log_context_for(callback), interval=interval, first=interval)
+    
+    def add_handlers(self, application):
+        """Зарегистрировать обработчики апдейтов"""
+        # Запись апдейтов видит их раньше всех
+        if self.recorder:
+            application.add_handler(TypeHandler(Update, self.record_update), group=-2)
+        
+        # Учет активности чатов до всех остальных обработчиков
+        application.add_handler(TypeHandler(Update, self.track_update), group=-1)
         
         # Команды
         application.add_handler(CommandHandler("start", self.start))
@@ -1116,6 +3069,11 @@ class KotakBot:
         application.add_handler(CommandHandler("profile", self.profile_command))
         application.add_handler(CommandHandler("server", self.server_command))
         application.add_handler(CommandHandler("help", self.menu))
+        application.add_handler(CommandHandler("history", self.history_command))
+        application.add_handler(CommandHandler("stats", self.stats_command))
+        application.add_handler(CommandHandler("storage", self.storage_command))
+        application.add_handler(CommandHandler("backup", self.backup_command))
+        application.add_handler(CommandHandler("profiler", self.profiler_command))
         
         # Обработчики кнопок
         application.add_handler(CallbackQueryHandler(self.handle_callback))
@@ -1123,14 +3081,787 @@ class KotakBot:
         # Обработчики сообщений (для викторин)
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         
+        # Записи лога из обработчиков получают chat_id, user_id и имя обработчика
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                handler.callback = log_context_for(handler.callback)
+    
+    def run(self):
+        """Запуск бота"""
+        # Создаем Application
+        application = (
+            Application.builder()
+            .token(TOKEN)
+            .post_stop(self.flush_notifications)
+            .post_shutdown(self.shutdown)
+            .build()
+        )
+        self.add_handlers(application)
+        
         # Настройка периодических задач
         self.setup_jobs(application)
         
+        # kill -USR1 <pid> включает профилирование без перезапуска
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(
+                signal.SIGUSR1,
+                lambda signum, frame: self.start_profiler(self.config["profiler"]["default_seconds"])
+            )
+            
         # Запуск
         logger.info("Котак бот запускается...")
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+# ==================== ВОСПРОИЗВЕДЕНИЕ АПДЕЙТОВ ====================
+class FakeBotRequest(BaseRequest):
+    """Заглушка Bot API: отвечает правдоподобными объектами без сети"""
+    
+    def __init__(self):
+        self.calls = {}  # метод API -> число вызовов
+        self._message_id = 0
+    
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+        
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Kotak", "username": "kotak_replay_bot"}
+        elif api_method in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            result = {
+                "message_id": int(params.get("message_id", self._message_id)),
+                "date": int(clock.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "group"},
+                "text": params.get("text", "")
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class UpdateReplayer:
+    """Прогон записанных апдейтов через обработчики бота на чистой БД"""
+    
+    # Столбцы со временем записи не сравниваются между прогонами
+    VOLATILE_COLUMNS = {"created_at", "last_active", "last_collected", "last_worked", "last_activity", "next_due"}
+    CHECKSUM_TABLES = ("users", "user_properties", "servers", "jobs", "inventory", "chat_users",
+                       "chats", "quizzes", "events_log", "balance_ledger")
+    
+    def __init__(self, path: str, speed: float = 0, clock: Optional[VirtualClock] = None):
+        self.path = path
+        self.speed = speed
+        self.clock = clock  # виртуальные часы выставляются на время записи апдейта
+        self.latencies = {}  # обработчик -> список задержек в секундах
+    
+    def read(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        with opener(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    
+    @staticmethod
+    def handler_name(application, update: Update) -> str:
+        """Имя обработчика, который сработает на апдейт (служебные группы пропускаем)"""
+        for group in sorted(application.handlers):
+            if group < 0:
+                continue
+            for handler in application.handlers[group]:
+                if handler.check_update(update):
+                    return handler.callback.__name__
+        return "без обработчика"
+    
+    async def replay(self, bot: "KotakBot") -> FakeBotRequest:
+        request = FakeBotRequest()
+        application = (
+            Application.builder()
+            .token("0:replay")
+            .request(request)
+            .get_updates_request(request)
+            .build()
+        )
+        bot.add_handlers(application)
+        await application.initialize()
+        
+        previous = None
+        try:
+            for record in self.read():
+                if self.speed and previous is not None:
+                    await asyncio.sleep(max(0.0, record["t"] - previous) / self.speed)
+                previous = record["t"]
+                if self.clock:
+                    self.clock.set(record["t"])
+                
+                update = Update.de_json(record["update"], application.bot)
+                name = self.handler_name(application, update)
+                started = time.perf_counter()
+                await application.process_update(update)
+                self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        finally:
+            await application.shutdown()
+        return request
+    
+    @classmethod
+    def checksums(cls, db: Database) -> Dict[str, str]:
+        """Контрольные суммы таблиц без столбцов со временем"""
+        result = {}
+        for table in cls.CHECKSUM_TABLES:
+            columns = [
+                row['name'] for row in db.fetch_all(f"PRAGMA table_info({table})")
+                if row['name'] not in cls.VOLATILE_COLUMNS
+            ]
+            digest = hashlib.sha256()
+            cursor = db.conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {', '.join(columns)}")
+            for row in cursor:
+                digest.update(repr(tuple(row)).encode())
+            result[table] = digest.hexdigest()[:16]
+        return result
+
+
+def replay_command(args):
+    """Воспроизведение записанных апдейтов из командной строки"""
+    db_file = args.db or os.path.join(tempfile.mkdtemp(prefix="kotak-replay-"), "replay.sqlite")
+    if os.path.exists(db_file):
+        raise SystemExit(f"БД {db_file} уже существует, для воспроизведения нужна чистая")
+        
+    Database.db_file = db_file
+    random.seed(args.seed)
+    virtual_clock = VirtualClock()
+    use_clock(virtual_clock)
+    bot = KotakBot()
+    bot.recorder = None
+    replayer = UpdateReplayer(args.file, speed=args.speed, clock=virtual_clock)
+    
+    started = time.monotonic()
+    request = asyncio.run(replayer.replay(bot))
+    elapsed = time.monotonic() - started
+    
+    # Сбрасываем буферы, чтобы состояние в БД было полным
+    bot.flush_state()
+    
+    total = sum(len(values) for values in replayer.latencies.values())
+    print(f"Апдейтов: {total} за {elapsed:.2f} с, БД: {db_file}\n")
+    print(f"{'обработчик':<24} {'число':>7} {'сред, мс':>9} {'p50, мс':>9} {'p95, мс':>9} {'макс, мс':>9}")
+    for name, values in sorted(replayer.latencies.items()):
+        values = sorted(values)
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(f"{name:<24} {len(values):>7} {statistics.mean(values) * 1000:>9.2f} "
+              f"{statistics.median(values) * 1000:>9.2f} {p95 * 1000:>9.2f} {values[-1] * 1000:>9.2f}")
+              
+    print("\nВызовы Bot API:")
+    for method, count in sorted(request.calls.items()):
+        print(f"  {method}: {count}")
+        
+    # Счетчики, которые обработчики вели по ходу, должны совпасть с полным пересчетом
+    drifted = bot.economy.recompute()
+    print(f"\nСтатистика чатов: расхождений с пересчетом {drifted}")
+        
+    print("\nКонтрольные суммы:")
+    for table, checksum in UpdateReplayer.checksums(bot.db).items():
+        print(f"  {table}: {checksum}")
+        
+    if drifted:
+        raise SystemExit(f"Статистика разошлась в {drifted} чатах")
+
+# ==================== ПРОГОН НА ВИРТУАЛЬНОМ ВРЕМЕНИ ====================
+class SoakRunner:
+    """Многодневный прогон периодических задач на виртуальных часах"""
+    
+    def __init__(self, bot: "KotakBot", clock: VirtualClock):
+        self.bot = bot
+        self.clock = clock
+        self.runs = {}  # задача -> [число запусков, суммарное время]
+    
+    def populate(self, chats: int, players: int):
+        """Заполнить чистую БД чатами и работающими игроками"""
+        db = self.bot.db
+        members = []
+        for chat_index in range(chats):
+            chat_id = -(1000000 + chat_index)
+            for player_index in range(players):
+                members.append((chat_id, chat_index * players + player_index + 1))
+                
+        with db.transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO chat_users (chat_id, user_id, last_active) VALUES (?, ?, clock_now())",
+                members
+            )
+        for _, user_id in members:
+            state = GameState(user_id)
+            state.get_user()
+            state.get_server()
+            state.set_job(*random.choice(GameEngine.JOBS))
+    
+    async def run(self, seconds: float) -> FakeBotRequest:
+        request = FakeBotRequest()
+        application = Application.builder().token("0:soak").request(request).get_updates_request(request).build()
+        await application.initialize()
+        context = CallbackContext(application)
+        
+        self.bot.load_state()
+        jobs = self.bot.periodic_jobs()
+        start = self.clock.time()
+        next_runs = [start + interval for _, interval in jobs]
+        try:
+            # Часы прыгают сразу к ближайшему сроку, без ожидания
+            while True:
+                index = min(range(len(jobs)), key=next_runs.__getitem__)
+                if next_runs[index] > start + seconds:
+                    break
+                callback, interval = jobs[index]
+                self.clock.set(next_runs[index])
+                next_runs[index] += interval
+                
+                started = time.perf_counter()
+                await callback(context)
+                stats = self.runs.setdefault(callback.__name__, [0, 0.0])
+                stats[0] += 1
+                stats[1] += time.perf_counter() - started
+        finally:
+            await application.shutdown()
+        return request
+
+
+def soak_command(args):
+    """Нагрузочный прогон периодических задач из командной строки"""
+    db_file = args.db or os.path.join(tempfile.mkdtemp(prefix="kotak-soak-"), "soak.sqlite")
+    if os.path.exists(db_file):
+        raise SystemExit(f"БД {db_file} уже существует, для прогона нужна чистая")
+        
+    Database.db_file = db_file
+    random.seed(args.seed)
+    virtual_clock = VirtualClock()
+    use_clock(virtual_clock)
+    bot = KotakBot()
+    bot.recorder = None
+    bot.config["backup"]["interval"] = 0
+    # БД прогона одноразовая: fsync на каждом коммите только тормозит
+    bot.db.conn.execute("PRAGMA synchronous = OFF")
+    
+    runner = SoakRunner(bot, virtual_clock)
+    runner.populate(args.chats, args.players)
+    started = time.monotonic()
+    request = asyncio.run(runner.run(args.days * 86400))
+    elapsed = time.monotonic() - started
+    bot.flush_state()
+    
+    print(f"Прогон {args.days} дн. виртуального времени за {elapsed:.2f} с, БД: {db_file}\n")
+    print(f"{'задача':<24} {'запусков':>9} {'всего, с':>9} {'сред, мс':>9}")
+    for name, (count, total) in sorted(runner.runs.items()):
+        print(f"{name:<24} {count:>9} {total:>9.2f} {total / count * 1000:>9.2f}")
+        
+    print("\nВызовы Bot API:")
+    for method, count in sorted(request.calls.items()):
+        print(f"  {method}: {count}")
+        
+    totals = bot.db.fetch_one('''
+        SELECT COUNT(*) AS players, SUM(balance) AS money FROM users
+    ''')
+    print(f"\nИгроков: {totals['players']}, денег: {totals['money']}₽")
+    print(f"Спящих чатов: {bot.db.fetch_one('SELECT COUNT(*) AS n FROM chats WHERE hibernated = 1')['n']}")
+
+# ==================== ЭКСПОРТ ДАННЫХ ====================
+class TableExporter:
+    """Потоковая выгрузка таблицы порциями по ключу из read-only соединения"""
+    
+    # таблица -> (ключ, столбец времени, время хранится как unix-время)
+    TABLES = {
+        "users": ("user_id", "created_at", False),
+        "user_properties": ("user_id", None, False),
+        "servers": ("user_id", "last_collected", False),
+        "jobs": ("user_id", "last_worked", False),
+        "events_log": ("id", "created_at", False),
+        "quizzes": ("id", "created_at", False),
+        "balance_ledger": ("id", "created_at", True),
+        "chats": ("chat_id", "last_activity", True),
+    }
+    
+    ARROW_TYPES = {"INTEGER": "int64", "BOOLEAN": "int64", "REAL": "float64"}
+    
+    def __init__(self, db_file: str, table: str, chunk_size: int = 5000, pause: float = 0):
+        if table not in self.TABLES:
+            raise ValueError(f"Таблицу {table} выгружать нельзя, доступны: {', '.join(self.TABLES)}")
+        self.table = table
+        self.chunk_size = chunk_size
+        self.pause = pause
+        # Только чтение: выгрузка не может ничего испортить и не берет блокировку записи
+        self.conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+        self.columns = [
+            (row[1], (row[2] or "TEXT").upper()) for row in self.conn.execute(f"PRAGMA table_info({table})")
+        ]
+    
+    def chunks(self, since: Optional[float] = None, until: Optional[float] = None):
+        """Порции строк по возрастанию ключа; каждая порция - отдельный короткий запрос"""
+        key, time_column, epoch = self.TABLES[self.table]
+        conditions = [f"{key} > ?"]
+        params = []
+        if time_column:
+            moment = "?" if epoch else "datetime(?, 'unixepoch')"
+            if since is not None:
+                conditions.append(f"{time_column} >= {moment}")
+                params.append(since)
+            if until is not None:
+                conditions.append(f"{time_column} < {moment}")
+                params.append(until)
+        elif since is not None or until is not None:
+            raise ValueError(f"У таблицы {self.table} нет столбца времени")
+            
+        query = (
+            f"SELECT {', '.join(name for name, _ in self.columns)} FROM {self.table} "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {key} LIMIT ?"
+        )
+        key_index = [name for name, _ in self.columns].index(key)
+        last_key = -2 ** 63
+        while True:
+            rows = self.conn.execute(query, (last_key, *params, self.chunk_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.chunk_size:
+                return
+            last_key = rows[-1][key_index]
+            if self.pause:
+                time.sleep(self.pause)
+    
+    def to_csv(self, path: str, **filters) -> int:
+        opener = gzip.open if path.endswith(".gz") else open
+        written = 0
+        with opener(path, 'wt', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([name for name, _ in self.columns])
+            for rows in self.chunks(**filters):
+                writer.writerows(rows)
+                written += len(rows)
+        return written
+    
+    def to_parquet(self, path: str, **filters) -> int:
+        if pa is None:
+            raise RuntimeError("Для экспорта в parquet нужен pyarrow: pip install pyarrow")
+        # Схема из объявленных типов, чтобы порции с NULL не меняли типы столбцов
+        schema = pa.schema([
+            (name, getattr(pa, self.ARROW_TYPES.get(declared, "string"))())
+            for name, declared in self.columns
+        ])
+        written = 0
+        with pq.ParquetWriter(path, schema) as writer:
+            for rows in self.chunks(**filters):
+                columns = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                written += len(rows)
+        return written
+    
+    def close(self):
+        self.conn.close()
+
+
+def parse_moment(value: Optional[str]) -> Optional[float]:
+    """Дата 'ГГГГ-ММ-ДД[ ЧЧ:ММ[:СС]]' в UTC -> unix-время"""
+    if value is None:
+        return None
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def export_command(args):
+    """Выгрузка таблицы из командной строки"""
+    config = DEFAULT_CONFIG
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = merge_config(DEFAULT_CONFIG, yaml.safe_load(f))
+            
+    output_format = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+    if output_format == "parquet" and pa is None:
+        # Проверяем до открытия базы и файла, чтобы не оставлять пустую выгрузку
+        raise SystemExit("Для экспорта в parquet нужен pyarrow: pip install pyarrow")
+        
+    exporter = TableExporter(
+        args.db,
+        args.table,
+        chunk_size=args.chunk_size or config["export"]["chunk_size"],
+        pause=config["export"]["pause"]
+    )
+    filters = {"since": parse_moment(args.since), "until": parse_moment(args.until)}
+    
+    started = time.monotonic()
+    try:
+        if output_format == "parquet":
+            written = exporter.to_parquet(args.output, **filters)
+        else:
+            written = exporter.to_csv(args.output, **filters)
+    finally:
+        exporter.close()
+    print(f"{args.table}: {written} строк -> {args.output} за {time.monotonic() - started:.2f} с")
+
+# ==================== БЕНЧМАРК ЗАПИСЕЙ ====================
+RECORD_TABLES = ((User, "users"), (Properties, "user_properties"), (Server, "servers"), (Job, "jobs"))
+
+
+def read_as_dicts(db: Database, user_id: int) -> list:
+    """Прежний способ: SELECT * -> sqlite3.Row -> dict, доступ по ключу"""
+    result = []
+    for _, table in RECORD_TABLES:
+        row = dict(db.fetch_one(f"SELECT * FROM {table} WHERE user_id = ?", (user_id,)))
+        row['user_id']
+        result.append(row)
+    return result
+
+
+def read_as_records(db: Database, user_id: int) -> list:
+    """Записи со слотами, только нужные столбцы, доступ по атрибуту"""
+    result = []
+    for record_type, _ in RECORD_TABLES:
+        record = db.fetch_record(record_type, user_id)
+        record.user_id
+        result.append(record)
+    return result
+
+
+def bench_command(args):
+    """Сравнение чтения профиля игрока через dict и через записи"""
+    Database.db_file = os.path.join(tempfile.mkdtemp(prefix="kotak-bench-"), "bench.sqlite")
+    db = Database()
+    for user_id in range(1, args.players + 1):
+        state = GameState(user_id)
+        state.get_user()
+        state.get_properties()
+        state.get_server()
+        state.get_job()
+    user_ids = [random.randint(1, args.players) for _ in range(args.iterations)]
+    
+    print(f"{'способ':<10} {'мкс/профиль':>12} {'байт/профиль':>13}")
+    for name, read in (("dict", read_as_dicts), ("записи", read_as_records)):
+        read(db, 1)  # прогрев кэша запросов
+        started = time.perf_counter()
+        for user_id in user_ids:
+            read(db, user_id)
+        elapsed = time.perf_counter() - started
+        
+        # Память: сколько занимают удерживаемые результаты чтения
+        sample = user_ids[:args.memory_sample]
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [read(db, user_id) for user_id in sample]
+        retained = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del kept
+        
+        print(f"{name:<10} {elapsed / len(user_ids) * 1e6:>12.1f} {retained / len(sample):>13.0f}")
+
+# ==================== СИМУЛЯТОР ЭКОНОМИКИ ====================
+class EconomySimulator:
+    """Офлайн-симуляция экономики для подбора баланса"""
+    
+    STATS = ("health", "energy", "happiness")
+    DEFAULT_POLICIES = {"idle": 0.2, "careful": 0.5, "spender": 0.3}
+    
+    def __init__(self, config: dict, players: int = 10000, chat_size: int = 20,
+                 policy_mix: Optional[Dict[str, float]] = None, quiz_answer_rate: float = 0.5,
+                 action_interval: int = 1800, seed: Optional[int] = None):
+        if np is None:
+            raise RuntimeError("Для симуляции нужен numpy: pip install numpy")
+            
+        self.game = config["game"]
+        self.prices = config["prices"]
+        self.rng = np.random.default_rng(seed)
+        self.chat_size = chat_size
+        self.chats = max(1, players // chat_size)
+        self.players = self.chats * chat_size
+        self.quiz_answer_rate = quiz_answer_rate
+        self.action_interval = action_interval
+        self.step = None
+        n = self.players
+        
+        mix = policy_mix or self.DEFAULT_POLICIES
+        self.policy_names = list(mix)
+        weights = np.array([mix[name] for name in self.policy_names], dtype=float)
+        self.policy = self.rng.choice(len(self.policy_names), size=n, p=weights / weights.sum())
+        
+        self.balance = np.full(n, self.game["start_balance"], dtype=np.int64)
+        self.stats = {stat: np.full(n, 100, dtype=np.int64) for stat in self.STATS}
+        
+        # Пассивные игроки остаются безработными, остальные выбирают случайную работу
+        job = self.rng.integers(0, len(GameEngine.JOBS), size=n)
+        employed = ~self._policy_mask("idle")
+        self.salary = np.where(employed, np.array([salary for _, salary, _ in GameEngine.JOBS])[job], 0)
+        self.stress = np.where(employed, np.array([stress for _, _, stress in GameEngine.JOBS])[job], 0)
+        
+        self.server_level = np.ones(n, dtype=np.int64)
+        self.server_income = np.full(n, self.game["server_income"], dtype=np.int64)
+        self.has_girlfriend = np.zeros(n, dtype=bool)
+        self.girlfriend_happiness = np.zeros(n, dtype=np.int64)
+        self.has_car = np.zeros(n, dtype=bool)
+        self.has_house = np.zeros(n, dtype=bool)
+        self.has_business = np.zeros(n, dtype=bool)
+        
+        # Справочник событий в виде массивов для векторного применения
+        stat_names = ("balance",) + self.STATS
+        events = GameEngine.RANDOM_EVENTS
+        self._event_stat = np.array([stat_names.index(stat) for _, _, stat, _, _, _ in events])
+        self._event_sign = np.array([sign for _, _, _, sign, _, _ in events])
+        self._event_low = np.array([low for _, _, _, _, low, _ in events])
+        self._event_high = np.array([high for _, _, _, _, _, high in events])
+    
+    def _policy_mask(self, name: str):
+        if name not in self.policy_names:
+            return np.zeros(self.players, dtype=bool)
+        return self.policy == self.policy_names.index(name)
+    
+    def _add_stat(self, stat: str, delta):
+        self.stats[stat] = np.clip(self.stats[stat] + delta, 0, 100)
+    
+    def _members(self, chats):
+        """Случайный участник каждого из переданных чатов"""
+        return chats * self.chat_size + self.rng.integers(0, self.chat_size, size=len(chats))
+    
+    def _quiz(self):
+        answered = np.flatnonzero(self.rng.random(self.chats) < self.quiz_answer_rate)
+        low, high = GameEngine.QUIZ_REWARD_RANGE
+        self.balance[self._members(answered)] += self.rng.integers(low, high + 1, size=len(answered))
+    
+    def _salary(self):
+        self.balance += self.salary
+        self._add_stat("energy", -(self.stress // 10))
+    
+    def _server_income(self):
+        self.balance += self.server_income
+    
+    def _decay(self):
+        n = self.players
+        for stat, chance, low, high in GameEngine.DECAY_RULES:
+            hit = self.rng.random(n) < chance
+            self._add_stat(stat, -self.rng.integers(low, high + 1, size=n) * hit)
+            
+        chance, low, high = GameEngine.GIRLFRIEND_DECAY
+        hit = self.has_girlfriend & (self.rng.random(n) < chance)
+        self.girlfriend_happiness = np.maximum(
+            0, self.girlfriend_happiness - self.rng.integers(low, high + 1, size=n) * hit
+        )
+    
+    def _random_events(self):
+        chats = np.flatnonzero(self.rng.random(self.chats) < 0.2)
+        members = self._members(chats)
+        event = self.rng.integers(0, len(GameEngine.RANDOM_EVENTS), size=len(chats))
+        amount = self._event_sign[event] * self.rng.integers(self._event_low[event], self._event_high[event] + 1)
+        
+        # В одном чате событие получает один игрок, поэтому индексы не повторяются
+        for index, target in enumerate(("balance",) + self.STATS):
+            selected = self._event_stat[event] == index
+            if target == "balance":
+                self.balance[members[selected]] += amount[selected]
+            else:
+                values = self.stats[target]
+                values[members[selected]] = np.clip(values[members[selected]] + amount[selected], 0, 100)
+    
+    def _buy(self, mask, price: int):
+        """Списать цену у тех, кто может себе это позволить. Возвращает маску покупателей"""
+        buyers = mask & (self.balance >= price)
+        self.balance -= price * buyers
+        return buyers
+    
+    def _act(self):
+        """Действия игроков по их стратегиям"""
+        prices = self.prices
+        active = ~self._policy_mask("idle")
+        spender = self._policy_mask("spender")
+        health, energy = self.stats["health"], self.stats["energy"]
+        
+        # Лечение и еда
+        self._add_stat("health", 30 * self._buy(active & (health < 50), prices["medicine"]))
+        fed = self._buy(active & ((energy < 40) | (self.stats["health"] < 70)), prices["food"])
+        self._add_stat("health", 10 * fed)
+        self._add_stat("energy", 15 * fed)
+        
+        # Разовая работа через /work
+        worked = active & (self.salary > 0) & (self.stats["energy"] >= 40)
+        self.balance += (self.salary // 4) * worked
+        self._add_stat("energy", -20 * worked)
+        self._add_stat("happiness", -(self.stress // 20) * worked)
+        
+        # Осторожные копят запас, транжиры тратят все
+        reserve = np.where(spender, 0, 1000)
+        upgraded = self._buy(active & (self.balance >= reserve + prices["server_upgrade"]), prices["server_upgrade"])
+        self.server_level += upgraded
+        self.server_income += 15 * upgraded
+        
+        new_girlfriend = self._buy(spender & ~self.has_girlfriend, 1000)
+        self.has_girlfriend |= new_girlfriend
+        self.girlfriend_happiness[new_girlfriend] = 80
+        gifted = self._buy(self.has_girlfriend & active & (self.girlfriend_happiness < 50), prices["girlfriend_gift"])
+        self.girlfriend_happiness = np.minimum(100, self.girlfriend_happiness + 40 * gifted)
+        
+        self.has_car |= self._buy(spender & ~self.has_car, prices["car"])
+        self.has_business |= self._buy(spender & self.has_car & ~self.has_business, prices["business"])
+        self.has_house |= self._buy(spender & self.has_business & ~self.has_house, prices["house"])
+    
+    def summary(self, day: float) -> dict:
+        p10, p50, p90 = np.percentile(self.balance, [10, 50, 90])
+        row = {
+            "day": day,
+            "balance_p10": int(p10),
+            "balance_p50": int(p50),
+            "balance_p90": int(p90),
+            "broke_share": float(np.mean(self.balance < self.prices["food"])),
+            "server_level": float(np.mean(self.server_level)),
+            "car_share": float(np.mean(self.has_car)),
+            "house_share": float(np.mean(self.has_house)),
+        }
+        for stat in self.STATS:
+            row[f"{stat}_mean"] = float(np.mean(self.stats[stat]))
+            row[f"{stat}_low_share"] = float(np.mean(self.stats[stat] < 20))
+        for index, name in enumerate(self.policy_names):
+            mask = self.policy == index
+            row[f"{name}_balance_p50"] = int(np.median(self.balance[mask])) if mask.any() else 0
+        return row
+    
+    def run(self, days: float = 7, report_every: float = 1) -> List[dict]:
+        """Прогнать симуляцию, возвращая сводку каждые report_every дней"""
+        game = self.game
+        ticks = [
+            (game["quiz_interval"], self._quiz),
+            (game["salary_interval"], self._salary),
+            (game["server_interval"], self._server_income),
+            (game["decay_interval"], self._decay),
+            (game["events_interval"], self._random_events),
+            (self.action_interval, self._act),
+        ]
+        step = self.step = math.gcd(*(interval for interval, _ in ticks))
+        report_seconds = int(report_every * 86400)
+        
+        rows = [self.summary(0)]
+        for second in range(step, int(days * 86400) + 1, step):
+            for interval, tick in ticks:
+                if second % interval == 0:
+                    tick()
+            if second % report_seconds == 0:
+                rows.append(self.summary(second / 86400))
+        return rows
+
+
+def simulate_command(args):
+    """Запуск симулятора из командной строки"""
+    config = DEFAULT_CONFIG
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = merge_config(DEFAULT_CONFIG, yaml.safe_load(f))
+            
+    policy_mix = None
+    if args.policies:
+        policy_mix = {}
+        for part in args.policies.split(","):
+            name, weight = part.split("=")
+            policy_mix[name.strip()] = float(weight)
+            
+    sim = EconomySimulator(
+        config,
+        players=args.players,
+        chat_size=args.chat_size,
+        policy_mix=policy_mix,
+        quiz_answer_rate=args.quiz_answer_rate,
+        seed=args.seed
+    )
+    started = time.monotonic()
+    rows = sim.run(days=args.days, report_every=args.report_every)
+    elapsed = time.monotonic() - started
+    
+    columns = ["day", "balance_p10", "balance_p50", "balance_p90", "broke_share",
+               "health_mean", "energy_mean", "happiness_mean", "server_level"]
+    columns += [f"{name}_balance_p50" for name in sim.policy_names]
+    print(" ".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        print(" ".join(
+            f"{row[column]:>16.2f}" if isinstance(row[column], float) else f"{row[column]:>16}"
+            for column in columns
+        ))
+        
+    player_ticks = sim.players * int(args.days * 86400 / sim.step)
+    print(f"\n{sim.players} игроков, {args.days} дней за {elapsed:.2f} с "
+          f"(~{player_ticks / max(elapsed, 1e-9):,.0f} игроко-тиков/с)")
+          
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
 # ==================== ЗАПУСК ====================
+def main():
+    parser = argparse.ArgumentParser(description="КОТАК BOT")
+    commands = parser.add_subparsers(dest="command")
+    
+    simulate = commands.add_parser("simulate", help="офлайн-симуляция экономики")
+    simulate.add_argument("--players", type=int, default=10000)
+    simulate.add_argument("--chat-size", type=int, default=20)
+    simulate.add_argument("--days", type=float, default=28)
+    simulate.add_argument("--report-every", type=float, default=7, help="период сводки в днях")
+    simulate.add_argument("--policies", help="доли стратегий, например idle=0.2,careful=0.5,spender=0.3")
+    simulate.add_argument("--quiz-answer-rate", type=float, default=0.5)
+    simulate.add_argument("--seed", type=int)
+    simulate.add_argument("--csv", help="сохранить сводки в CSV")
+    
+    replay = commands.add_parser("replay", help="воспроизвести записанные апдейты на чистой БД")
+    replay.add_argument("file", help="файл записи (.jsonl или .jsonl.gz)")
+    replay.add_argument("--db", help="путь к новой БД, по умолчанию во временном каталоге")
+    replay.add_argument("--speed", type=float, default=0, help="ускорение относительно записи, 0 - без пауз")
+    replay.add_argument("--seed", type=int, default=0)
+    
+    soak = commands.add_parser("soak", help="многодневный прогон периодических задач на виртуальном времени")
+    soak.add_argument("--days", type=float, default=7)
+    soak.add_argument("--chats", type=int, default=20)
+    soak.add_argument("--players", type=int, default=10, help="игроков в каждом чате")
+    soak.add_argument("--db", help="путь к новой БД, по умолчанию во временном каталоге")
+    soak.add_argument("--seed", type=int, default=0)
+    
+    bench = commands.add_parser("bench", help="сравнить чтение профиля через dict и через записи")
+    bench.add_argument("--players", type=int, default=1000)
+    bench.add_argument("--iterations", type=int, default=50000)
+    bench.add_argument("--memory-sample", type=int, default=5000)
+    
+    vacuum = commands.add_parser("vacuum", help="разово включить incremental auto_vacuum и сжать БД")
+    vacuum.add_argument("--db", default=DB_FILE)
+    
+    export = commands.add_parser("export", help="потоковая выгрузка таблицы в CSV или parquet")
+    export.add_argument("table", choices=sorted(TableExporter.TABLES))
+    export.add_argument("output", help="файл выгрузки (.csv, .csv.gz или .parquet)")
+    export.add_argument("--format", choices=["csv", "parquet"], help="по умолчанию по расширению файла")
+    export.add_argument("--since", help="с момента, UTC: 2024-01-31 или '2024-01-31 12:00'")
+    export.add_argument("--until", help="до момента (не включая), UTC")
+    export.add_argument("--db", default=DB_FILE)
+    export.add_argument("--chunk-size", type=int)
+    
+    args = parser.parse_args()
+    if args.command == "simulate":
+        simulate_command(args)
+    elif args.command == "replay":
+        replay_command(args)
+    elif args.command == "soak":
+        soak_command(args)
+    elif args.command == "export":
+        export_command(args)
+    elif args.command == "bench":
+        bench_command(args)
+    elif args.command == "vacuum":
+        vacuum_command(args)
+    else:
+        bot = KotakBot()
+        bot.run()
+
+
 if __name__ == "__main__":
-    bot = KotakBot()
-    bot.run()
+    main()